@@ -0,0 +1,135 @@
+#Maintenance of the aggregates derived from record_projects
+#
+#project_phases.hours is the sum of the declared hours of the project whose date_rec falls in the phase,
+#bounds included. When two phases contain the same day (the end of a phase is the start of the next one),
+#the hours go to the first phase. Every write to record_projects applies the signed delta of the rows it
+#adds or removes with apply_phase_hours, and recompute_phase_hours rebuilds the totals in one statement. The
+#column has one decimal like the declared hours, so the deltas add up exactly to the recomputed totals.
+#
+#monthly_modified_hours is initialized per month by the "reset monthly hours" method and then edited by
+#the Business Managers. Every write to the records of an already initialized month (new weeks included)
+#is applied to it as deltas with apply_monthly_hours, months that are not initialized yet are left to the reset.
+#The functions return statements, to execute with db.session (sync) or an AsyncSession.
+import datetime
+from decimal import Decimal
+
+from sqlalchemy import DateTime, Integer, Numeric, String, and_, column, exists, func, select, update, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+
+#Import models from models.py
+from models import MonthlyModifiedHours as ModelMonthlyModifiedHours
+from models import ProjectPhase as ModelProjectPhase
+from models import RecordProjects as ModelRecordProjects
+
+
+def _phase_of(project_id, date_rec):
+    # First phase of the project containing date_rec, correlated to the outer query
+    phase = aliased(ModelProjectPhase)
+    return (select(func.min(phase.project_phase))
+            .where(phase.project_id == project_id,
+                   phase.start_date <= date_rec,
+                   phase.end_date >= date_rec)
+            .scalar_subquery())
+
+
+def phase_hours_deltas(rows, sign=1):
+    # (project_id, date_rec, hours) of record_projects rows (models or dicts), signed
+    deltas = []
+    for row in rows:
+        if isinstance(row, dict):
+            project_id, date_rec, hours = row["project_id"], row["date_rec"], row["declared_hours"]
+        else:
+            project_id, date_rec, hours = row.project_id, row.date_rec, row.declared_hours
+        if project_id is not None and hours:
+            deltas.append((project_id, date_rec, sign * Decimal(str(hours))))
+    return deltas
+
+
+def apply_phase_hours(deltas):
+    """UPDATE adding the signed (project_id, date_rec, hours) deltas to the matching phases,
+    or None when there is nothing to apply."""
+    if not deltas:
+        return None
+
+    delta_rows = values(column("project_id", Integer), column("date_rec", DateTime), column("hours", Numeric),
+                        name="deltas").data(deltas)
+    by_phase = select(delta_rows.c.project_id,
+                      _phase_of(delta_rows.c.project_id, delta_rows.c.date_rec).label("project_phase"),
+                      delta_rows.c.hours).subquery()
+    totals = (select(by_phase.c.project_id, by_phase.c.project_phase, func.sum(by_phase.c.hours).label("hours"))
+              .where(by_phase.c.project_phase.isnot(None))
+              .group_by(by_phase.c.project_id, by_phase.c.project_phase)
+              .subquery())
+
+    return (update(ModelProjectPhase)
+            .where(ModelProjectPhase.project_id == totals.c.project_id,
+                   ModelProjectPhase.project_phase == totals.c.project_phase)
+            .values(hours=func.coalesce(ModelProjectPhase.hours, 0) + totals.c.hours)
+            .execution_options(synchronize_session=False))
+
+
+def recompute_phase_hours(project_ids=None):
+    """UPDATE rebuilding the hours of every phase (or of the phases of project_ids) from record_projects,
+    phases without any declared hours are set to 0."""
+    by_phase = select(ModelRecordProjects.project_id,
+                      _phase_of(ModelRecordProjects.project_id, ModelRecordProjects.date_rec).label("project_phase"),
+                      ModelRecordProjects.declared_hours)
+    if project_ids is not None:
+        by_phase = by_phase.where(ModelRecordProjects.project_id.in_(project_ids))
+    by_phase = by_phase.subquery()
+    totals = (select(by_phase.c.project_id, by_phase.c.project_phase, func.sum(by_phase.c.declared_hours).label("hours"))
+              .where(by_phase.c.project_phase.isnot(None))
+              .group_by(by_phase.c.project_id, by_phase.c.project_phase)
+              .subquery())
+
+    phase = aliased(ModelProjectPhase)
+    new_hours = (select(phase.project_id, phase.project_phase, func.coalesce(totals.c.hours, 0).label("hours"))
+                 .outerjoin(totals, and_(totals.c.project_id == phase.project_id,
+                                         totals.c.project_phase == phase.project_phase)))
+    if project_ids is not None:
+        new_hours = new_hours.where(phase.project_id.in_(project_ids))
+    new_hours = new_hours.subquery()
+
+    return (update(ModelProjectPhase)
+            .where(ModelProjectPhase.project_id == new_hours.c.project_id,
+                   ModelProjectPhase.project_phase == new_hours.c.project_phase)
+            .values(hours=new_hours.c.hours)
+            .execution_options(synchronize_session=False))
+
+
+def monthly_hours_deltas(rows, sign=1):
+    # (user_id, project_id, domain, month, hours) of record_projects rows (models or dicts), signed.
+    # A week belongs to the month of its Wednesday, like in the "reset monthly hours" method
+    deltas = []
+    for row in rows:
+        if not isinstance(row, dict):
+            row = {"user_id": row.user_id, "project_id": row.project_id, "domain": row.domain,
+                   "date_rec": row.date_rec, "declared_hours": row.declared_hours}
+        if row["project_id"] is not None and row["declared_hours"]:
+            month = datetime.datetime(row["date_rec"].year, row["date_rec"].month, 1)
+            deltas.append((row["user_id"], row["project_id"], row["domain"], month, sign * Decimal(str(row["declared_hours"]))))
+    return deltas
+
+
+def apply_monthly_hours(deltas):
+    """INSERT ... ON CONFLICT adding the signed (user_id, project_id, domain, month, hours) deltas to
+    monthly_modified_hours, for the months already initialized, or None when there is nothing to apply."""
+    totals = {}
+    for user_id, project_id, domain, month, hours in deltas:
+        key = (user_id, project_id, domain, month)
+        totals[key] = totals.get(key, 0) + hours
+    totals = [key + (hours,) for key, hours in totals.items() if hours != 0]
+    if not totals:
+        return None
+
+    delta_rows = values(column("user_id", Integer), column("project_id", Integer), column("domain", String),
+                        column("month", DateTime), column("hours", Numeric), name="deltas").data(totals)
+    initialized = exists().where(ModelMonthlyModifiedHours.month == delta_rows.c.month)
+    statement = insert(ModelMonthlyModifiedHours).from_select(
+        ["user_id", "project_id", "domain", "month", "total_hours"],
+        select(delta_rows.c.user_id, delta_rows.c.project_id, delta_rows.c.domain, delta_rows.c.month, delta_rows.c.hours)
+        .where(initialized))
+    return statement.on_conflict_do_update(
+        index_elements=["user_id", "project_id", "month", "domain"],
+        set_={"total_hours": func.coalesce(ModelMonthlyModifiedHours.total_hours, 0) + statement.excluded.total_hours})
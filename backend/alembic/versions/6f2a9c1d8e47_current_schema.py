@@ -0,0 +1,210 @@
+"""Current schema
+
+Replaces the tables of the first migration (hoursuser, project and the removed register table)
+with the schema of models.py. Their columns cannot be converted (the new ones are mostly NOT NULL,
+without a value for the existing rows): the tables are dropped, so the upgrade, like the downgrade,
+refuses to run when one of the tables it drops has rows.
+
+Revision ID: 6f2a9c1d8e47
+Revises: d3e0f7242459
+Create Date: 2026-10-18 09:12:40.518203
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f2a9c1d8e47'
+down_revision = 'd3e0f7242459'
+branch_labels = None
+depends_on = None
+
+
+def _check_empty(hint, *tables):
+    # Not checked when the SQL is only generated (--sql)
+    if context.is_offline_mode():
+        return
+    connection = op.get_bind()
+    filled = [table for table in tables
+              if connection.execute(sa.select(sa.literal(1)).select_from(sa.table(table)).limit(1)).first() is not None]
+    if filled:
+        raise RuntimeError("Revision 6f2a9c1d8e47 would drop the rows of " + ", ".join(filled) + ". " + hint)
+
+
+def upgrade():
+    _check_empty("A database created before Alembic was used already has the current schema: "
+                 "mark it with 'alembic stamp 6f2a9c1d8e47' instead of upgrading.",
+                 'register', 'project', 'hoursuser')
+    op.drop_index(op.f('ix_register_worked_hours'), table_name='register')
+    op.drop_index(op.f('ix_register_id'), table_name='register')
+    op.drop_table('register')
+    op.drop_index(op.f('ix_project_name'), table_name='project')
+    op.drop_index(op.f('ix_project_id'), table_name='project')
+    op.drop_index(op.f('ix_project_division'), table_name='project')
+    op.drop_index(op.f('ix_project_classification'), table_name='project')
+    op.drop_table('project')
+    op.drop_index(op.f('ix_hoursuser_username'), table_name='hoursuser')
+    op.drop_index(op.f('ix_hoursuser_id'), table_name='hoursuser')
+    op.drop_index(op.f('ix_hoursuser_email'), table_name='hoursuser')
+    op.drop_table('hoursuser')
+
+    op.create_table('hoursuser',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('username', sa.String(), nullable=False),
+    sa.Column('email', sa.String(), nullable=False),
+    sa.Column('domain', sa.String(), nullable=False),
+    sa.Column('role', sa.String(), nullable=False),
+    sa.Column('view', sa.Boolean(), nullable=False),
+    sa.Column('date_entrance', sa.DateTime(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email')
+    )
+    op.create_index(op.f('ix_hoursuser_id'), 'hoursuser', ['id'], unique=False)
+    op.create_table('project',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('entity', sa.String(), nullable=False),
+    sa.Column('division', sa.String(), nullable=False),
+    sa.Column('sub_category', sa.String(), nullable=False),
+    sa.Column('classification', sa.String(), nullable=False),
+    sa.Column('type', sa.String(), nullable=False),
+    sa.Column('project_name', sa.String(), nullable=False),
+    sa.Column('project_code', sa.String(), nullable=False),
+    sa.Column('project_manager', sa.String(), nullable=True),
+    sa.Column('complexity', sa.Integer(), nullable=True),
+    sa.Column('start_cap_date', sa.DateTime(), nullable=False),
+    sa.Column('end_cap_date', sa.DateTime(), nullable=False),
+    sa.Column('start_date', sa.DateTime(), nullable=True),
+    sa.Column('end_date', sa.DateTime(), nullable=True),
+    sa.Column('status', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('project_code')
+    )
+    op.create_index(op.f('ix_project_id'), 'project', ['id'], unique=False)
+    op.create_table('monthly_report',
+    sa.Column('sync_date', sa.DateTime(), nullable=True),
+    sa.Column('closed', sa.Boolean(), nullable=False),
+    sa.Column('month', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('month')
+    )
+    op.create_table('record',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('date_rec', sa.DateTime(), nullable=False),
+    sa.Column('comment', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['hoursuser.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'date_rec')
+    )
+    op.create_table('buffer_daily_register',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('day_date', sa.DateTime(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('daily_hours', sa.Numeric(precision=3, scale=1), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['hoursuser.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'day_date', 'project_id')
+    )
+    op.create_table('favorites',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['hoursuser.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_favorites_id'), 'favorites', ['id'], unique=False)
+    op.create_table('monthly_modified_hours',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('month', sa.DateTime(), nullable=False),
+    sa.Column('total_hours', sa.Numeric(precision=3, scale=1), nullable=True),
+    sa.Column('domain', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['hoursuser.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'project_id', 'month', 'domain')
+    )
+    op.create_table('project_monthly_information',
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('month', sa.DateTime(), nullable=False),
+    sa.Column('forecast_hours', sa.Numeric(precision=3, scale=1), nullable=True),
+    sa.Column('capitalizable', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.PrimaryKeyConstraint('project_id', 'month')
+    )
+    op.create_table('project_phases',
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('project_phase', sa.Integer(), nullable=False),
+    sa.Column('start_date', sa.DateTime(), nullable=False),
+    sa.Column('end_date', sa.DateTime(), nullable=False),
+    sa.Column('hours', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.PrimaryKeyConstraint('project_id', 'project_phase')
+    )
+    op.create_table('record_projects',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('date_rec', sa.DateTime(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=True),
+    sa.Column('declared_hours', sa.Numeric(precision=3, scale=1), nullable=False),
+    sa.Column('domain', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.ForeignKeyConstraint(['user_id', 'date_rec'], ['record.user_id', 'record.date_rec'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_record_projects_id'), 'record_projects', ['id'], unique=False)
+
+
+def downgrade():
+    _check_empty("Export the data or empty the tables before downgrading.",
+                 'record_projects', 'project_phases', 'project_monthly_information', 'monthly_modified_hours',
+                 'favorites', 'buffer_daily_register', 'record', 'monthly_report', 'project', 'hoursuser')
+    op.drop_index(op.f('ix_record_projects_id'), table_name='record_projects')
+    op.drop_table('record_projects')
+    op.drop_table('project_phases')
+    op.drop_table('project_monthly_information')
+    op.drop_table('monthly_modified_hours')
+    op.drop_index(op.f('ix_favorites_id'), table_name='favorites')
+    op.drop_table('favorites')
+    op.drop_table('buffer_daily_register')
+    op.drop_table('record')
+    op.drop_table('monthly_report')
+    op.drop_index(op.f('ix_project_id'), table_name='project')
+    op.drop_table('project')
+    op.drop_index(op.f('ix_hoursuser_id'), table_name='hoursuser')
+    op.drop_table('hoursuser')
+
+    op.create_table('hoursuser',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('username', sa.String(), nullable=True),
+    sa.Column('email', sa.String(), nullable=True),
+    sa.Column('password', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_hoursuser_email'), 'hoursuser', ['email'], unique=True)
+    op.create_index(op.f('ix_hoursuser_id'), 'hoursuser', ['id'], unique=False)
+    op.create_index(op.f('ix_hoursuser_username'), 'hoursuser', ['username'], unique=False)
+    op.create_table('project',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('division', sa.String(), nullable=True),
+    sa.Column('classification', sa.String(), nullable=True),
+    sa.Column('type', sa.Boolean(), nullable=True),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('capitalization', sa.Boolean(), nullable=True),
+    sa.Column('entity', sa.Boolean(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_project_classification'), 'project', ['classification'], unique=False)
+    op.create_index(op.f('ix_project_division'), 'project', ['division'], unique=False)
+    op.create_index(op.f('ix_project_id'), 'project', ['id'], unique=False)
+    op.create_index(op.f('ix_project_name'), 'project', ['name'], unique=False)
+    op.create_table('register',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('worked_hours', sa.Integer(), nullable=True),
+    sa.Column('project_id', sa.Integer(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['hoursuser.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_register_id'), 'register', ['id'], unique=False)
+    op.create_index(op.f('ix_register_worked_hours'), 'register', ['worked_hours'], unique=False)
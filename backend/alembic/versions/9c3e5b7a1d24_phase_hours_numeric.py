@@ -0,0 +1,43 @@
+"""Phase hours with decimals
+
+project_phases.hours is kept up to date with the declared hours of each write (half hours). As an integer,
+it was rounded on every update and drifted from the sum of the records: it becomes a numeric with one
+decimal and is rebuilt from record_projects.
+
+Revision ID: 9c3e5b7a1d24
+Revises: e41f7a3b9c06
+Create Date: 2026-10-19 10:04:51.208337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3e5b7a1d24'
+down_revision = 'e41f7a3b9c06'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column('project_phases', 'hours', type_=sa.Numeric(precision=10, scale=1),
+                    existing_type=sa.Integer(), existing_nullable=True)
+    # Same totals as aggregates.recompute_phase_hours: a day in two phases counts in the first one
+    op.execute("""
+        UPDATE project_phases AS phase
+        SET hours = COALESCE((SELECT sum(rp.declared_hours)
+                              FROM record_projects AS rp
+                              WHERE rp.project_id = phase.project_id
+                                AND (SELECT min(first.project_phase)
+                                     FROM project_phases AS first
+                                     WHERE first.project_id = rp.project_id
+                                       AND first.start_date <= rp.date_rec
+                                       AND first.end_date >= rp.date_rec) = phase.project_phase), 0)
+    """)
+
+
+def downgrade():
+    op.alter_column('project_phases', 'hours', type_=sa.Integer(),
+                    existing_type=sa.Numeric(precision=10, scale=1), existing_nullable=True,
+                    postgresql_using='round(hours)::integer')
@@ -0,0 +1,41 @@
+"""Indexes of the hot queries
+
+Composite indexes on the columns the records, KPI and monthly hours methods filter on.
+buffer_daily_register is already served by its primary key (user_id, day_date, project_id).
+The indexes are built CONCURRENTLY so that the tables stay writable during the migration.
+
+Revision ID: b83e51c0d2f9
+Revises: 6f2a9c1d8e47
+Create Date: 2026-10-18 10:03:17.264915
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83e51c0d2f9'
+down_revision = '6f2a9c1d8e47'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_record_projects_project_id_date_rec', 'record_projects', ['project_id', 'date_rec']),
+    ('ix_record_projects_user_id_date_rec', 'record_projects', ['user_id', 'date_rec']),
+    ('ix_monthly_modified_hours_month_project_id', 'monthly_modified_hours', ['month', 'project_id']),
+    ('ix_project_monthly_information_month', 'project_monthly_information', ['month']),
+    ('ix_favorites_user_id_project_id', 'favorites', ['user_id', 'project_id']),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,30 @@
+"""Table versions
+
+Write counters of the catalog tables, used to build the ETags of the catalog endpoints.
+
+Revision ID: e41f7a3b9c06
+Revises: b83e51c0d2f9
+Create Date: 2026-10-18 14:21:08.730154
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41f7a3b9c06'
+down_revision = 'b83e51c0d2f9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('table_version',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+
+
+def downgrade():
+    op.drop_table('table_version')
@@ -4,31 +4,47 @@ import json
 import base64
 from copy import copy
 import os
+import requests
+import threading
+import time
+from collections import OrderedDict
 
 
 #Import FastAPI dependencies
 from fastapi import Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi_sqlalchemy import db
 from fastapi.security import OAuth2PasswordBearer
 
 #Import SQLAlchemy dependencies
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 #Import libraries for token decryption
 from jose import jwt, jws
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from jose.exceptions import JWSError, JWTError
+from jwks import JWKSKeyStore
 
 #Import schemas from schemas.py
 from schemas import HoursUserBase as SchemaHoursUserBase
+from schemas import AuthenticatedUser as SchemaAuthenticatedUser
 
 #Import models from models.py
 from models import HoursUser as ModelHoursUser
 
-from database import SessionLocal
+from catalog import select_versions
+
+from database import SessionLocal, get_async_db
 from dotenv import load_dotenv
 
 load_dotenv(".env")
 DISCOVERY_URL = os.getenv("DISCOVERY_URL")
+JWT_ALGORITHMS = ["RS256"]
+
+#Signing keys of the identity provider, fetched once and refreshed in the background
+key_store = JWKSKeyStore(DISCOVERY_URL,
+                         refresh_interval=float(os.getenv("JWKS_REFRESH_SECONDS", "3600")),
+                         min_refetch_interval=float(os.getenv("JWKS_MIN_REFETCH_SECONDS", "60")))
 
 #OAuthScheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl = "token")
@@ -46,56 +62,133 @@ def jwt_payload_decode(jwt):
     _, payload, _ = jwt.split('.')
     return json.loads(_b64_decode(payload))
 
-async def get_user (token: str = Depends(oauth2_scheme)):
+def user_entities(email: str) -> List[str]:
+    # THE FOLLOWING LINES ARE FOCAL NAIM SPECIFIC, if you want to extract the project KPI software to other organizations, please implement the function :
+    #   return the organizations (entities) of the user. For Focal Naim, the name of organization is in email
+    org = []
+    if ('focal' in email):
+        org.append('FOCAL')
+    if ('naim' in email):
+        org.append('NAIM')
+    return org
+
+
+class IdentityCache:
+    """Bounded token -> user cache. Entries are evicted at the token `exp` claim,
+    after at most `ttl` seconds, or when the cache grows over `maxsize` (least recently used first).
+    Every entry keeps the version of the hoursuser table it was read at, and is dropped once the
+    version changes: a user updated through any worker process is read again by all of them."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str, version: int):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, user_version, user = entry
+            if expires_at <= time.time() or user_version != version:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return user
+
+    def set(self, token: str, user, version: int, exp=None):
+        expires_at = time.time() + self.ttl
+        if exp is not None:
+            expires_at = min(expires_at, float(exp))
+        if expires_at <= time.time() or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (expires_at, version, user)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+identity_cache = IdentityCache(maxsize=int(os.getenv("IDENTITY_CACHE_SIZE", "1024")),
+                               ttl=float(os.getenv("IDENTITY_CACHE_TTL_SECONDS", "300")))
+
+
+async def get_user (token: str = Depends(oauth2_scheme), session: AsyncSession = Depends(get_async_db)):
+    # The version is read before the user, a write committed in between only reloads the user once more
+    version_rows = (await session.execute(select_versions("hoursuser"))).all()
+    version = dict(version_rows).get("hoursuser", 0)
+    cached_user = identity_cache.get(token, version)
+    if cached_user is not None:
+        return cached_user
+
     try:
         decoded_token = jwt_payload_decode(token)
         username = decoded_token['name']
         email = decoded_token['unique_name']
     
-        user=db.session.query(ModelHoursUser).filter(ModelHoursUser.username  == username,
-                                                     ModelHoursUser.email  == email).first()
-
-        return SchemaHoursUserBase(username=user.username,
-                               email = user.email,
-                               role=user.role)
+        user=(await session.execute(select(ModelHoursUser).filter(ModelHoursUser.username  == username,
+                                                                  ModelHoursUser.email  == email))).scalars().first()
+
+        authenticated_user = SchemaAuthenticatedUser(id=user.id,
+                                                     username=user.username,
+                                                     email=user.email,
+                                                     domain=user.domain,
+                                                     role=user.role,
+                                                     view=user.view,
+                                                     date_entrance=user.date_entrance,
+                                                     status=user.status,
+                                                     entities=user_entities(user.email))
     except Exception as e :
         raise HTTPException(status_code=401, detail="User not found")
 
+    identity_cache.set(token, authenticated_user, version, decoded_token.get('exp'))
+    return authenticated_user
+
+
+
+#Role dependencies. They read the role of the identity resolved by get_user (cached, one version query)
+#and reject the request before the body of the endpoint runs
+PROJECT_MANAGER_ROLES = ("Project Manager", "Business Manager")
+BUSINESS_MANAGER_ROLES = ("Business Manager",)
+
+def require_roles(*roles: str):
+    async def check_role(user: SchemaAuthenticatedUser = Depends(get_user)):
+        if user.role not in roles:
+            raise HTTPException(status_code=401, detail="Unauthorized access")
+        return user
+    return check_role
+
+require_pm = require_roles(*PROJECT_MANAGER_ROLES)
+require_bm = require_roles(*BUSINESS_MANAGER_ROLES)
 
 
 # Authentication Middleware
 async def test_auth (token: str = Depends(oauth2_scheme)):
-    response=requests.get(DISCOVERY_URL)
-    data = response.json()
-    public_keys_uri = data
-    public_keys = requests.get(public_keys_uri["jwks_uri"]).json()
-
-    header = jwt.get_unverified_header(token)
-    kid = header.get("kid")
-    alg = header.get("alg")
-
-    key = next(key for key in public_keys["keys"] if key["kid"] == kid)
-    modulus = base64.urlsafe_b64decode(key["n"] + "==")
-    exponent_bytes = base64.urlsafe_b64decode(key["e"] + "==")
-    exponent = int.from_bytes(exponent_bytes, byteorder="big", signed=False)
-    mod = int.from_bytes(modulus, byteorder="big", signed=False)
-
-    # Construct RSA public key
-    public_numbers = rsa.RSAPublicNumbers(exponent, mod)
-    public_key = public_numbers.public_key()
-
-    # Serialize the RSA public key to PEM format
-    pem_public_key = public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
-
-    # Convert bytes to string and remove leading/trailing whitespaces
-    pem_public_key_str = pem_public_key.decode("utf-8").strip()
-    
-    verif = jws.verify(token,pem_public_key,alg)
+    try:
+        header = jwt.get_unverified_header(token)
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    # A refetch of the keys is a blocking HTTP call, made out of the event loop
+    try:
+        public_key = await run_in_threadpool(key_store.get_key, header.get("kid"))
+    except requests.RequestException:
+        raise HTTPException(status_code=503, detail="Failed to fetch public keys")
+
+    if public_key is None:
+        raise HTTPException(status_code=401, detail="Unknown signing key")
+
+    try:
+        verif = jws.verify(token, public_key, JWT_ALGORITHMS)
+    except JWSError:
+        raise HTTPException(status_code=401, detail="Invalid token signature")
 
-    return pem_public_key_str
+    return json.loads(verif)
 
 # Fetch the Azure public key
 def get_azure_public_key():
@@ -0,0 +1,108 @@
+#Versions of the catalog tables and conditional GETs of the catalog endpoints
+#
+#The frontend reloads the catalogs (projects, favorites, users, project monthly information) on most
+#navigations. Every endpoint writing one of the CATALOG_TABLES bumps its counter in table_version, in the
+#same transaction as the write. The ETag of a catalog response is made of the versions it depends on and of
+#what selects the rows (entities of the user, user id, month), a request whose If-None-Match matches gets a
+#304 without reading nor serializing the catalog. The counters are in the database, so all the worker
+#processes agree on them. After a manual change of a catalog table, bump its version with a POST on
+#/api/_internal/table_versions.
+#
+#The project list is also kept in memory by project_catalog, for the version of the project table it was
+#read at: a request that gets a new version from table_version reloads it, whichever worker made the write.
+import threading
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+#Import schemas from schemas.py
+from schemas import Project as SchemaProject
+
+#Import models from models.py
+from models import TableVersion as ModelTableVersion
+
+from responses import dumps
+
+CATALOG_TABLES = ("project", "favorites", "hoursuser", "project_monthly_information")
+
+#Catalog responses may be stored by the browser but must be revalidated before every use
+CATALOG_CACHE_CONTROL = "private, no-cache"
+
+
+def bump_versions(*tables):
+    """INSERT ... ON CONFLICT incrementing the version of the tables, to execute before the commit of the write."""
+    statement = insert(ModelTableVersion).values([{"table_name": table, "version": 1} for table in tables])
+    return statement.on_conflict_do_update(index_elements=["table_name"],
+                                           set_={"version": ModelTableVersion.version + 1})
+
+
+def select_versions(*tables):
+    """SELECT of the (table_name, version) rows of the tables, a table never written has no row (version 0)."""
+    return select(ModelTableVersion.table_name, ModelTableVersion.version).where(ModelTableVersion.table_name.in_(tables))
+
+
+def make_etag(name, tables, version_rows, *parts):
+    # Weak ETag: the same versions always give an equivalent body, not necessarily the same bytes
+    versions = dict(version_rows)
+    tokens = [name] + [str(versions.get(table, 0)) for table in tables] + [str(part) for part in parts]
+    return 'W/"' + "-".join(tokens) + '"'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    # If-None-Match uses the weak comparison, W/ prefixes are ignored
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag.removeprefix("W/") for candidate in candidates)
+
+
+def conditional_response(request: Request, response: Response, etag: str):
+    """Sets the ETag of the response and returns a 304 when the If-None-Match header of the request matches it,
+    None otherwise. The versions must be read before the catalog: a write committed in between then gives
+    an older ETag to the new rows, never the opposite."""
+    headers = {"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+class ProjectCatalog:
+    """Projects of one version of the project table, encoded once per scope: every project for the
+    Business Managers (entities None), the projects of the entities of the user otherwise."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+            self._projects = []
+            self._bodies = {}
+
+    def load(self, version, projects):
+        # Validated and encoded like the response_model of GET /api/projects
+        encoded = [jsonable_encoder(SchemaProject.from_orm(project)) for project in projects]
+        with self._lock:
+            self._version = version
+            self._projects = encoded
+            self._bodies = {}
+
+    def get(self, version, entities=None):
+        """(project count, JSON body) of the scope, None when the catalog is not at this version."""
+        with self._lock:
+            if self._version is None or self._version != version:
+                return None
+            key = None if entities is None else tuple(sorted(entities))
+            body = self._bodies.get(key)
+            if body is None:
+                projects = [project for project in self._projects if key is None or project["entity"] in key]
+                body = (len(projects), dumps(projects))
+                self._bodies[key] = body
+            return body
+
+
+project_catalog = ProjectCatalog()
@@ -0,0 +1,218 @@
+#Streaming of the CSV exports
+#
+#By default (CSV_EXPORT_MODE=copy) the export query is run by PostgreSQL as COPY (SELECT ...) TO STDOUT WITH CSV:
+#the rows are formatted by the server and written to the response as they arrive, without a Python object per row
+#nor a file on the disk, so concurrent exports cannot overwrite each other and the memory used does not depend on
+#the size of the export. psycopg2 only writes a COPY into a file object, so the COPY runs in a thread of its own,
+#on a connection of its own (the session of the request is closed before the body of a StreamingResponse is sent),
+#and writes into a bounded queue that the response reads. With CSV_EXPORT_MODE=cursor the rows are read through a
+#server-side cursor and formatted by the csv module, batch by batch: slower, the same file, kept as a fallback.
+#The chunks are read by Starlette in its thread pool and the event loop is not blocked by the database.
+#
+#The export queries run with EXPORT_STATEMENT_TIMEOUT_MS in place of DB_STATEMENT_TIMEOUT_MS. The query of an
+#export is stopped when its client disconnects.
+#
+#The workbook exports cannot be streamed (openpyxl saves a whole file): each request writes its own temporary
+#file, out of the event loop, which is removed once sent.
+import csv
+import io
+import os
+import queue
+import tempfile
+import threading
+
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+
+from database import engine
+
+CSV_EXPORT_MODE = os.getenv("CSV_EXPORT_MODE", "copy")
+EXPORT_STATEMENT_TIMEOUT_MS = int(os.getenv("EXPORT_STATEMENT_TIMEOUT_MS", "600000"))
+
+#Size of the chunks sent to the client, and number of chunks buffered ahead of a slow client
+COPY_CHUNK_SIZE = 64 * 1024
+COPY_QUEUE_SIZE = 16
+#Rows per chunk in the cursor mode
+EXPORT_BATCH_SIZE = 2000
+
+WORKBOOK_DIR = "./temp"
+
+_END = object()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class _QueuePipe:
+    """File object given to copy_expert: the rows written by COPY are grouped in chunks put in a bounded queue.
+    When the client goes away, the next write raises ExportCancelled and aborts the COPY."""
+
+    def __init__(self):
+        self.queue = queue.Queue(COPY_QUEUE_SIZE)
+        self.cancelled = False
+        self._buffer = bytearray()
+
+    def put(self, item):
+        while not self.cancelled:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise ExportCancelled()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= COPY_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            # Same line endings as the csv module
+            self.put(bytes(self._buffer).replace(b"\n", b"\r\n"))
+            self._buffer = bytearray()
+
+
+def _copy_query(cursor, statement):
+    # COPY takes no parameters, they are bound by psycopg2 on the client side
+    compiled = statement.compile(dialect=engine.dialect, compile_kwargs={"render_postcompile": True})
+    query = cursor.mogrify(str(compiled), compiled.params).decode()
+    return f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true, DELIMITER ';')"
+
+
+#Only for the transaction of the export, the connection goes back to the pool with its usual timeout
+SET_EXPORT_TIMEOUT = "SET LOCAL statement_timeout = %d" % EXPORT_STATEMENT_TIMEOUT_MS
+
+
+def _run_copy(statement, pipe):
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(SET_EXPORT_TIMEOUT)
+        cursor.copy_expert(_copy_query(cursor, statement), pipe)
+        cursor.close()
+        connection.rollback()
+        pipe.flush()
+        pipe.put(_END)
+    except ExportCancelled:
+        # The COPY was interrupted in the middle of the stream, the connection is not reused
+        connection.invalidate()
+    except Exception as e:
+        connection.invalidate()
+        try:
+            pipe.put(e)
+        except ExportCancelled:
+            pass
+    finally:
+        connection.close()
+
+
+class CopyChunks:
+    """CSV of `statement` (header from the column labels, ';' delimiter), by chunks of COPY_CHUNK_SIZE bytes.
+    cancel stops the COPY."""
+
+    def __init__(self, statement):
+        self._pipe = _QueuePipe()
+        threading.Thread(target=_run_copy, args=(statement, self._pipe), daemon=True).start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Waits by steps, a cancel from another thread ends the iteration
+        while not self._pipe.cancelled:
+            try:
+                chunk = self._pipe.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if chunk is _END:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            return chunk
+        raise StopIteration
+
+    def cancel(self):
+        self._pipe.cancelled = True
+
+
+class CursorChunks:
+    """Same CSV as CopyChunks, read through a server-side cursor, by chunks of EXPORT_BATCH_SIZE rows.
+    cancel closes the cursor and its connection."""
+
+    def __init__(self, statement):
+        self.cancelled = False
+        self._chunks = self._read(statement)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self._chunks)
+        if self.cancelled:
+            self._chunks.close()
+            raise StopIteration
+        return chunk
+
+    def _read(self, statement):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=";")
+        with engine.begin() as connection:
+            connection.exec_driver_sql(SET_EXPORT_TIMEOUT)
+            result = connection.execution_options(stream_results=True).execute(statement)
+            writer.writerow(result.keys())
+            yield buffer.getvalue().encode()
+            for rows in result.partitions(EXPORT_BATCH_SIZE):
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerows(rows)
+                yield buffer.getvalue().encode()
+
+    def cancel(self):
+        self.cancelled = True
+        try:
+            self._chunks.close()
+        except ValueError:
+            # A batch is being read in another thread, __next__ closes the chunks once it is read
+            pass
+
+
+def csv_chunks(statement):
+    """Chunks of the CSV export of `statement`, read as set by CSV_EXPORT_MODE."""
+    if CSV_EXPORT_MODE == "cursor":
+        return CursorChunks(statement)
+    return CopyChunks(statement)
+
+
+class _ExportResponse(StreamingResponse):
+    """StreamingResponse cancelling its chunks once it ends: sent, failed, or stopped by the disconnect
+    of the client. Starlette stops reading the chunks at the disconnect but leaves the query running."""
+
+    def __init__(self, chunks, **kwargs):
+        super().__init__(chunks, **kwargs)
+        self.chunks = chunks
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.chunks.cancel()
+
+
+def csv_response(chunks, filename):
+    return _ExportResponse(chunks, media_type="text/csv",
+                           headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+async def workbook_response(write_workbook, session, filename, *args):
+    """Response of the workbook written by write_workbook(session, path, *args) in a file of its own."""
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", dir=WORKBOOK_DIR, delete=False) as file:
+        path = file.name
+    try:
+        await run_in_threadpool(write_workbook, session, path, *args)
+    except BaseException:
+        os.remove(path)
+        raise
+    return FileResponse(path, filename=filename, background=BackgroundTask(os.remove, path))
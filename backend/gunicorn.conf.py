@@ -0,0 +1,40 @@
+#Gunicorn settings of the production server, see start.sh
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv(".env")
+
+#Binding and workers. Every worker is a uvicorn event loop with its own connection pools (DB_POOL_SIZE)
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+
+#Import the application once in the master, the workers are forked with the code already loaded
+preload_app = os.getenv("PRELOAD_APP", "true").lower() in ("1", "true", "yes")
+
+#Worker recycling: restart a worker after max_requests (+ random jitter so that they do not restart together),
+#let the running requests finish for graceful_timeout seconds, kill a worker blocked for more than timeout seconds
+max_requests = int(os.getenv("MAX_REQUESTS", "5000"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "500"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
+#Keep-alive of the connections with the reverse proxy, above the idle timeout of traefik
+keepalive = int(os.getenv("KEEP_ALIVE", "75"))
+
+#Headers set by traefik are trusted
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "*")
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
+
+
+def post_fork(server, worker):
+    # With preload_app the engines are created in the master: drop the inherited pools so that
+    # every worker opens its own connections instead of sharing the sockets of its parent
+    from database import async_engine, engine
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
@@ -0,0 +1,327 @@
+#Bulk imports of the CSV files (POST /api/import-csv, PUT /api/import-csv-monthly)
+#
+#The uploaded file is read by chunks of UPLOAD_CHUNK_SIZE bytes and parsed as it is read, out of the event loop
+#(run_import is called with run_in_threadpool). The rows go by batches of IMPORT_BATCH_SIZE to a writer thread,
+#which writes a batch while the next one is parsed, so the memory used does not depend on the size of the file.
+#
+#Records: the lines are checked in Python against the users and projects loaded once (one query each). The valid
+#rows are loaded with COPY into a temporary staging table, where the weeks are checked (WEEK_HOURS), then merged
+#with a few set-based statements: the weeks of the file replace the stored weeks (their record_projects rows are
+#deleted), the missing records are created, the phase hours and the initialized monthly hours are adjusted by the
+#difference (see aggregates.py, a week that did not exist counts in full, like in POST /api/records).
+#
+#In both imports nothing is written when a line is invalid and the errors of every line are reported. Everything
+#runs in the transaction of the given connection, the caller commits or rolls back.
+import abc
+import codecs
+import csv
+import datetime
+import io
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, Numeric, String, Table, and_, bindparam, delete, func, insert, select, tuple_, union_all, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+#Import models from models.py
+from models import HoursUser as ModelHoursUser
+from models import MonthlyModifiedHours as ModelMonthlyModifiedHours
+from models import Project as ModelProject
+from models import Record as ModelRecord
+from models import RecordProjects as ModelRecordProjects
+
+from aggregates import apply_monthly_hours, apply_phase_hours, monthly_hours_deltas, phase_hours_deltas
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+IMPORT_BATCH_SIZE = 5000
+MAX_IMPORT_ERRORS = 100
+WEEK_HOURS = 35
+MAX_HOURS = Decimal("99.9")
+
+#Staging table, dropped at the end of the transaction. Not part of models.Base, it is never created by create_all
+staging = Table("import_record_projects", MetaData(),
+                Column("line", Integer),
+                Column("user_id", Integer),
+                Column("date_rec", DateTime),
+                Column("project_id", Integer),
+                Column("domain", String),
+                Column("declared_hours", Numeric(precision=3, scale=1)),
+                prefixes=["TEMPORARY"],
+                postgresql_on_commit="DROP")
+
+
+class ImportFileError(Exception):
+    pass
+
+
+def upload_lines(file, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Lines of an UTF-8 binary file (the file of an UploadFile), read by chunks of chunk_size bytes."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    while True:
+        chunk = file.read(chunk_size)
+        lines = (pending + decoder.decode(chunk, final=not chunk)).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+        if not chunk:
+            break
+    if pending:
+        yield pending
+
+
+def run_import(import_class, connection, file):
+    """Parses the CSV file and imports its rows with import_class, returns the import (see error_count).
+    Raises ImportFileError when the file cannot be read."""
+    reader = csv.DictReader(upload_lines(file), delimiter=";")
+    try:
+        missing = [column for column in import_class.COLUMNS if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ImportFileError("Missing columns: " + ", ".join(missing))
+        file_import = import_class(connection)
+        try:
+            for row in reader:
+                file_import.add_row(reader.line_num, row)
+            file_import.finish()
+        finally:
+            file_import.close()
+    except (UnicodeDecodeError, csv.Error):
+        raise ImportFileError("Invalid input, please try again")
+    return file_import
+
+
+class _BatchedImport(abc.ABC):
+    """Rows checked by add_row and written by batches with _write, in a thread of their own: the previous batch
+    is written while the next one is parsed. Once a line is invalid nothing will be written, the rows are only
+    checked, unless STAGED (the rows go to a staging table, rolled back with the transaction). finish ends the
+    import, close must be called in every case."""
+
+    COLUMNS = ()
+    STAGED = False
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.errors = []
+        self.error_count = 0
+        self.row_count = 0
+        self._batch = []
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._writing = None
+
+    def error(self, line, detail):
+        self.error_count += 1
+        if len(self.errors) < MAX_IMPORT_ERRORS:
+            self.errors.append({"line": line, "detail": detail})
+
+    def error_detail(self):
+        return {"message": "Some lines are invalid, nothing was imported. Please check your input",
+                "errors": self.errors,
+                "error_count": self.error_count}
+
+    def append(self, row):
+        self.row_count += 1
+        self._batch.append(row)
+        if len(self._batch) >= IMPORT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.wait()
+        if self._batch and (self.STAGED or not self.error_count):
+            self._writing = self._writer.submit(self._write, self._batch)
+        self._batch = []
+
+    def wait(self):
+        writing, self._writing = self._writing, None
+        if writing is not None:
+            writing.result()
+
+    def finish(self):
+        self.flush()
+        self.wait()
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+
+    @abc.abstractmethod
+    def _write(self, batch):
+        """Writes the rows of the batch, in the writer thread."""
+
+
+class RecordsImport(_BatchedImport):
+    """Import of the records CSV: add_row for every line, then finish."""
+
+    COLUMNS = ("project_code", "week", "year", "name", "email", "domain", "hours")
+    # The staged rows are also used to check the weeks, see finish
+    STAGED = True
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self._users = dict(connection.execute(select(ModelHoursUser.email, ModelHoursUser.id)).all())
+        self._projects = dict(connection.execute(select(ModelProject.project_code, ModelProject.id)).all())
+        staging.create(connection)
+
+    def add_row(self, line, row):
+        try:
+            date_rec = datetime.date.fromisocalendar(int(row['year']), int(row['week']), 3)
+        except (TypeError, ValueError):
+            return self.error(line, "Invalid week or year")
+
+        try:
+            hours = Decimal(row['hours'])
+        except (TypeError, InvalidOperation):
+            return self.error(line, "Invalid hours")
+        if not hours.is_finite() or hours < 0 or hours > MAX_HOURS:
+            return self.error(line, "Invalid hours")
+
+        user_id = self._users.get(row['email'])
+        if user_id is None:
+            return self.error(line, "User " + str(row['name']) + " (" + str(row['email']) + ") not found")
+
+        project_id = self._projects.get(row['project_code'])
+        if project_id is None:
+            return self.error(line, "Project " + str(row['project_code']) + " not found")
+
+        self.append((line, user_id, date_rec, project_id, row['domain'] or "", hours))
+
+    def _write(self, batch):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+        cursor = self.connection.connection.cursor()
+        cursor.copy_expert("COPY import_record_projects (line, user_id, date_rec, project_id, domain, declared_hours) "
+                           "FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (domain))", buffer)
+        cursor.close()
+
+    def finish(self):
+        """Merges the staged rows, nothing is written when a line is invalid (see error_count)."""
+        super().finish()
+
+        # Weeks of the file not summing WEEK_HOURS, reported on their first line
+        week_totals = (select(staging.c.user_id, staging.c.date_rec, func.min(staging.c.line).label("line"),
+                              func.sum(staging.c.declared_hours).label("hours"))
+                       .group_by(staging.c.user_id, staging.c.date_rec)
+                       .having(func.sum(staging.c.declared_hours) != WEEK_HOURS)
+                       .subquery())
+        for line, email, date_rec, hours in self.connection.execute(
+                select(week_totals.c.line, ModelHoursUser.email, week_totals.c.date_rec, week_totals.c.hours)
+                .join(ModelHoursUser, ModelHoursUser.id == week_totals.c.user_id)
+                .order_by(week_totals.c.line)):
+            year, week, _ = date_rec.isocalendar()
+            self.error(line, f"Week {week} of {year} of {email} sums {hours} hours instead of {WEEK_HOURS}")
+        if self.error_count:
+            return
+
+        weeks = select(staging.c.user_id, staging.c.date_rec).distinct().subquery()
+
+        # Net deltas of the import, computed before the stored weeks are deleted and the new records created:
+        # the staged rows count positive, the stored rows of the same weeks negative
+        stored = (select(ModelRecordProjects.user_id, ModelRecordProjects.project_id, ModelRecordProjects.domain,
+                         ModelRecordProjects.date_rec, (-ModelRecordProjects.declared_hours).label("declared_hours"))
+                  .join(weeks, and_(ModelRecordProjects.user_id == weeks.c.user_id,
+                                    ModelRecordProjects.date_rec == weeks.c.date_rec)))
+        staged = select(staging.c.user_id, staging.c.project_id, staging.c.domain, staging.c.date_rec,
+                        staging.c.declared_hours)
+        rows = union_all(staged, stored).subquery()
+        phase_deltas = self.connection.execute(
+            select(rows.c.project_id, rows.c.date_rec, func.sum(rows.c.declared_hours).label("declared_hours"))
+            .group_by(rows.c.project_id, rows.c.date_rec)
+            .having(func.sum(rows.c.declared_hours) != 0)).all()
+        # A new week counts in full, apply_monthly_hours only changes the months already initialized
+        month = func.date_trunc("month", rows.c.date_rec)
+        monthly_deltas = self.connection.execute(
+            select(rows.c.user_id, rows.c.project_id, rows.c.domain, month.label("date_rec"),
+                   func.sum(rows.c.declared_hours).label("declared_hours"))
+            .group_by(rows.c.user_id, rows.c.project_id, rows.c.domain, month)
+            .having(func.sum(rows.c.declared_hours) != 0)).all()
+
+        # The weeks of the file replace the stored weeks
+        self.connection.execute(
+            delete(ModelRecordProjects)
+            .where(ModelRecordProjects.user_id == weeks.c.user_id, ModelRecordProjects.date_rec == weeks.c.date_rec))
+        self.connection.execute(
+            pg_insert(ModelRecord).from_select(["user_id", "date_rec"], select(weeks.c.user_id, weeks.c.date_rec))
+            .on_conflict_do_nothing())
+        # Projects with 0 hours are not stored, like in POST /api/records
+        self.connection.execute(
+            insert(ModelRecordProjects).from_select(
+                ["user_id", "date_rec", "project_id", "domain", "declared_hours"],
+                select(staging.c.user_id, staging.c.date_rec, staging.c.project_id, staging.c.domain,
+                       staging.c.declared_hours)
+                .where(staging.c.declared_hours != 0)
+                .order_by(staging.c.line)))
+
+        phase_update = apply_phase_hours(phase_hours_deltas(phase_deltas))
+        if phase_update is not None:
+            self.connection.execute(phase_update)
+        monthly_update = apply_monthly_hours(monthly_hours_deltas(monthly_deltas))
+        if monthly_update is not None:
+            self.connection.execute(monthly_update)
+
+
+class MonthlyHoursImport(_BatchedImport):
+    """Import of the monthly hours CSV: the total hours of the (user, project, month) are replaced, a new row
+    takes the domain of the user. The months are of 2023, like the file exported by the frontend."""
+
+    COLUMNS = ("month", "project", "hours", "user_id")
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self._users = dict(connection.execute(select(ModelHoursUser.id, ModelHoursUser.domain)).all())
+        self._projects = dict(connection.execute(select(ModelProject.project_code, ModelProject.id)).all())
+
+    def add_row(self, line, row):
+        try:
+            month = datetime.datetime(2023, int(row['month']), 1)
+        except (TypeError, ValueError):
+            return self.error(line, "Invalid month")
+
+        try:
+            hours = Decimal(row['hours'])
+        except (TypeError, InvalidOperation):
+            return self.error(line, "Invalid hours")
+        if not hours.is_finite() or hours < 0 or hours > MAX_HOURS:
+            return self.error(line, "Invalid hours")
+
+        try:
+            user_id = int(row['user_id'])
+        except (TypeError, ValueError):
+            return self.error(line, "Invalid user_id")
+        if user_id not in self._users:
+            return self.error(line, "User " + str(user_id) + " not found")
+
+        project_id = self._projects.get(row['project'])
+        if project_id is None:
+            return self.error(line, "Project " + str(row['project']) + " not found")
+
+        self.append((user_id, project_id, month, hours))
+
+    def _write(self, batch):
+        # The last line of a (user, project, month) wins
+        hours = {}
+        for user_id, project_id, month, total_hours in batch:
+            hours[(user_id, project_id, month)] = total_hours
+
+        existing = {}
+        for user_id, project_id, month, domain in self.connection.execute(
+                select(ModelMonthlyModifiedHours.user_id, ModelMonthlyModifiedHours.project_id,
+                       ModelMonthlyModifiedHours.month, ModelMonthlyModifiedHours.domain)
+                .where(tuple_(ModelMonthlyModifiedHours.user_id, ModelMonthlyModifiedHours.project_id,
+                              ModelMonthlyModifiedHours.month).in_(list(hours)))):
+            existing.setdefault((user_id, project_id, month), domain)
+
+        updates = [{"b_user_id": key[0], "b_project_id": key[1], "b_month": key[2], "b_domain": existing[key],
+                    "b_total_hours": total_hours}
+                   for key, total_hours in hours.items() if key in existing]
+        inserts = [{"user_id": key[0], "project_id": key[1], "month": key[2], "domain": self._users[key[0]] or "",
+                    "total_hours": total_hours}
+                   for key, total_hours in hours.items() if key not in existing]
+        if updates:
+            self.connection.execute(
+                update(ModelMonthlyModifiedHours)
+                .where(ModelMonthlyModifiedHours.user_id == bindparam("b_user_id"),
+                       ModelMonthlyModifiedHours.project_id == bindparam("b_project_id"),
+                       ModelMonthlyModifiedHours.month == bindparam("b_month"),
+                       ModelMonthlyModifiedHours.domain == bindparam("b_domain"))
+                .values(total_hours=bindparam("b_total_hours")), updates)
+        if inserts:
+            self.connection.execute(insert(ModelMonthlyModifiedHours), inserts)
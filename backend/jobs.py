@@ -0,0 +1,108 @@
+#Background jobs for the long operations (workbook exports, reset of the monthly hours)
+#
+#A job is submitted with a POST on /api/jobs/..., which returns its id at once. Its state is then polled on
+#/api/jobs/{job_id} and its result downloaded on /api/jobs/{job_id}/result. The jobs run in a pool of JOB_WORKERS
+#threads of the worker process that received them, each one with a session of its own (SessionLocal), so no request
+#waits for them. The state of a job (queued, running, done, failed) and its result file are written in JOBS_DIR:
+#every worker process can answer the polls and the downloads. A job interrupted by the stop of its process stays
+#"running". The files of the jobs are removed after JOB_RETENTION_SECONDS.
+import datetime
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = os.getenv("JOBS_DIR", "./temp/jobs")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "86400"))
+
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+
+def _state_path(job_id):
+    return os.path.join(JOBS_DIR, job_id + ".json")
+
+
+def result_path(job_id):
+    return os.path.join(JOBS_DIR, job_id + ".result")
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def _save(job):
+    # Written in a temporary file then renamed, a poll never reads a partial state
+    path = _state_path(job["id"])
+    with open(path + ".tmp", "w") as file:
+        json.dump(job, file)
+    os.replace(path + ".tmp", path)
+
+
+def _remove_expired():
+    limit = time.time() - JOB_RETENTION_SECONDS
+    for name in os.listdir(JOBS_DIR):
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_job(job_id):
+    """State of the job, None when it does not exist (or expired)."""
+    if not _JOB_ID.match(job_id):
+        return None
+    try:
+        with open(_state_path(job_id)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def submit(kind, user_id, function, filename=None, **params):
+    """Queues the job and returns its state. It runs function(session, **params), or function(session, path, **params)
+    when the job has a result file: filename is then the name of the download and path where to write it.
+    The message returned by the function (or the detail of an HTTPException) is kept in the state of the job."""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    _remove_expired()
+    job = {"id": uuid.uuid4().hex, "kind": kind, "status": "queued", "user_id": user_id, "params": params,
+           "filename": filename, "message": None, "created_at": _now(), "started_at": None, "finished_at": None}
+    _save(job)
+    _executor.submit(_run, job, function)
+    return job
+
+
+def _run(job, function):
+    job.update(status="running", started_at=_now())
+    _save(job)
+    session = SessionLocal()
+    try:
+        if job["filename"]:
+            message = function(session, result_path(job["id"]), **job["params"])
+        else:
+            message = function(session, **job["params"])
+        job.update(status="done", message=message)
+    except HTTPException as e:
+        session.rollback()
+        job.update(status="failed", message=e.detail)
+    except Exception:
+        session.rollback()
+        logger.exception("Job %s (%s) failed", job["id"], job["kind"])
+        job.update(status="failed", message="The job failed, please try again")
+    finally:
+        session.close()
+    job["finished_at"] = _now()
+    _save(job)
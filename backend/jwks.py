@@ -0,0 +1,101 @@
+#General library imports
+import base64
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+#Import libraries for key construction
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+logger = logging.getLogger(__name__)
+
+
+def _b64url_to_int(data: str) -> int:
+    data += '=' * (-len(data) % 4)
+    return int.from_bytes(base64.urlsafe_b64decode(data), byteorder="big", signed=False)
+
+
+def rsa_public_key_from_jwk(jwk: dict) -> rsa.RSAPublicKey:
+    # Build the RSA public key straight from the "n" (modulus) and "e" (exponent) of the JWK
+    public_numbers = rsa.RSAPublicNumbers(_b64url_to_int(jwk["e"]), _b64url_to_int(jwk["n"]))
+    return public_numbers.public_key()
+
+
+class JWKSKeyStore:
+    """Cache of the identity provider signing keys, indexed by `kid`.
+
+    The JWKS document is fetched once through the OpenID discovery document and
+    refreshed by a background thread every `refresh_interval` seconds. An unknown
+    `kid` triggers an immediate refetch (key rotation), at most once every
+    `min_refetch_interval` seconds so that forged headers cannot flood the provider.
+    """
+
+    def __init__(self, discovery_url: Optional[str], refresh_interval: float = 3600,
+                 min_refetch_interval: float = 60, timeout: float = 5):
+        self.discovery_url = discovery_url
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+
+        self._keys: Dict[str, rsa.RSAPublicKey] = {}
+        self._last_fetch = 0.0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        with self._lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        self._last_fetch = time.monotonic()
+        discovery = requests.get(self.discovery_url, timeout=self.timeout)
+        discovery.raise_for_status()
+        jwks = requests.get(discovery.json()["jwks_uri"], timeout=self.timeout)
+        jwks.raise_for_status()
+
+        keys = {}
+        for jwk in jwks.json().get("keys", []):
+            if jwk.get("kty") != "RSA" or "kid" not in jwk:
+                continue
+            keys[jwk["kid"]] = rsa_public_key_from_jwk(jwk)
+
+        # Swap the whole mapping at once so readers never see a partial key set
+        self._keys = keys
+        self._loaded = True
+
+    def get_key(self, kid: Optional[str]) -> Optional[rsa.RSAPublicKey]:
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+
+        with self._lock:
+            key = self._keys.get(kid)
+            if key is not None:
+                return key
+            if not self._loaded or time.monotonic() - self._last_fetch >= self.min_refetch_interval:
+                self._refresh_locked()
+                self._start_background_refresh()
+            return self._keys.get(kid)
+
+    def _start_background_refresh(self):
+        if self._thread is not None or self.refresh_interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, name="jwks-refresh", daemon=True)
+        self._thread.start()
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the previous keys until the provider is reachable again
+                logger.exception("Unable to refresh the JWKS signing keys")
+
+    def stop(self):
+        self._stop.set()
@@ -4,22 +4,23 @@ import base64
 import os
 import datetime
 from datetime import date, timedelta
-import csv
-import aiofiles
 import openpyxl
 from openpyxl.styles import Font, Alignment, PatternFill
 from copy import copy
 
 
 #Import FastAPI dependencies
-from fastapi import Depends, FastAPI , HTTPException, File, UploadFile
+from fastapi import Depends, FastAPI , HTTPException, File, UploadFile, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi_sqlalchemy import DBSessionMiddleware,db
+from fastapi_sqlalchemy import db
 from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
 
 #Import SQLAlchemy dependencies
-from sqlalchemy import func, desc, text, case, Date, and_, or_
-from auth_utils import get_user
+from sqlalchemy import func, desc, text, case, Date, Integer, and_, or_, select, insert, update, delete, tuple_, cast, extract, null
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from auth_utils import get_user, require_bm, require_pm
 
 #Import libraries for token decryption
 from decimal import Decimal
@@ -31,6 +32,7 @@ from schemas import FrontEndUser as SchemaFrontEndUser
 from schemas import Project as SchemaProject
 from schemas import Record as SchemaRecord
 from schemas import RecordProjects as SchemaRecordProjects
+from schemas import RecordWeek as SchemaRecordWeek
 from schemas import Favorites as SchemaFavorites
 from schemas import FrontendProjectPhase as SchemaProjectPhase
 from schemas import MonthlyModifiedHours as SchemaMonthlyModifiedHours
@@ -49,7 +51,14 @@ from models import MonthlyModifiedHours as ModelMonthlyModifiedHours
 from models import ProjectMonthlyInformation as ModelProjectMonthlyInformation
 from models import MonthlyReport as ModelMonthlyReport
 
-from database import SessionLocal
+from database import DBSessionMiddleware, SessionLocal, engine, async_engine, get_async_db, pool_status
+from profiling import QueryProfilerMiddleware, instrument_engine, route_metrics
+from aggregates import apply_monthly_hours, apply_phase_hours, monthly_hours_deltas, phase_hours_deltas, recompute_phase_hours
+from responses import encoded_response, json_response
+from exports import csv_chunks, csv_response, workbook_response
+from imports import ImportFileError, MonthlyHoursImport, RecordsImport, run_import
+from jobs import get_job, result_path, submit
+from catalog import CATALOG_TABLES, bump_versions, conditional_response, make_etag, project_catalog, select_versions
 from dotenv import load_dotenv
 
 
@@ -77,10 +86,19 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Before", "ETag"],
 )
 
 
-app.add_middleware(DBSessionMiddleware, db_url=os.environ["DATABASE_URL"])
+app.add_middleware(DBSessionMiddleware, custom_engine=engine)
+
+
+# SQL statement counter and DB time profiler, aggregated per route on /api/_metrics
+if os.getenv("QUERY_PROFILER", "true").lower() in ("1", "true", "yes"):
+    instrument_engine(engine)
+    instrument_engine(async_engine.sync_engine)
+    app.add_middleware(QueryProfilerMiddleware,
+                       server_timing=os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes"))
 
 
 def wrap_jwk_public_key(jwk):
@@ -115,6 +133,37 @@ def wrap_jwk_public_key(jwk):
 def read_root():
     return {"status": "OK"}
 
+#Connection pool telemetry (per worker process)
+@app.get("/api/_internal/pool")
+def read_pool_status(user: SchemaHoursUserBase = Depends(require_bm)):
+    return pool_status()
+
+#Rebuild of project_phases.hours from record_projects, in case the incremental updates drifted
+@app.post("/api/_internal/phase_hours")
+def repair_phase_hours(user: SchemaHoursUserBase = Depends(require_bm)):
+    db.session.execute(recompute_phase_hours())
+    db.session.commit()
+    return {"message": "Phase hours recomputed"}
+
+#New ETags for every catalog endpoint, after a change made outside of the API
+@app.post("/api/_internal/table_versions")
+def bump_table_versions(user: SchemaHoursUserBase = Depends(require_bm)):
+    db.session.execute(bump_versions(*CATALOG_TABLES))
+    db.session.commit()
+    return {"message": "Table versions bumped"}
+
+#Statement count and DB time per route (per worker process)
+@app.get("/api/_metrics")
+def read_query_metrics(user: SchemaHoursUserBase = Depends(require_bm)):
+    return route_metrics.as_dict()
+
+#Restart of the aggregation, returns the metrics aggregated until then
+@app.delete("/api/_metrics")
+def reset_query_metrics(user: SchemaHoursUserBase = Depends(require_bm)):
+    ans = route_metrics.as_dict()
+    route_metrics.reset()
+    return ans
+
 
 # PART 1: METHODS FOR THE EMPLOYEE PROFILE
 #____________________________________________________________________________________________________
@@ -126,18 +175,16 @@ async def get_hours_user(user: SchemaHoursUserBase = Depends(get_user)):
     
     if not user:
             raise HTTPException(status_code=400, detail="User not found")
-    model_user=db.session.query(ModelHoursUser).filter(ModelHoursUser.username  == user.username,
-                                                     ModelHoursUser.email  == user.email).first()
 
     frontenduser = SchemaFrontEndUser(
-        email=model_user.email,
-        username=model_user.username,
-        id=model_user.id,  
-        domain=model_user.domain,
-        role=model_user.role,
-        view=model_user.view,
-        date_entrance=model_user.date_entrance,
-        status=model_user.status)
+        email=user.email,
+        username=user.username,
+        id=user.id,  
+        domain=user.domain,
+        role=user.role,
+        view=user.view,
+        date_entrance=user.date_entrance,
+        status=user.status)
 
     return frontenduser
 
@@ -148,14 +195,12 @@ async def get_user_ID(user: SchemaHoursUserBase = Depends(get_user)):
     if not user:
             raise HTTPException(status_code=400, detail="User not found")
     
-    usermodel=db.session.query(ModelHoursUser).filter(ModelHoursUser.email  == user.email).first()
-    
-    return str(usermodel.id)
+    return str(user.id)
 
 
 # 1.3 Insert record
 @app.post("/api/records")
-async def insert_record(record: SchemaRecord, record_projects: List[SchemaRecordProjects], user: SchemaHoursUserBase = Depends(get_user)):
+async def insert_record(record: SchemaRecord, record_projects: List[SchemaRecordProjects], user: SchemaHoursUserBase = Depends(get_user), session: AsyncSession = Depends(get_async_db)):
     
     userID = await get_user_ID(user)
 
@@ -163,183 +208,215 @@ async def insert_record(record: SchemaRecord, record_projects: List[SchemaRecord
     if not str(record.user_id) == userID:
         raise HTTPException(status_code=401, detail="Unauthorized access")
     
-    if record.date_rec.weekday() != 2:
-            raise HTTPException(status_code=400,detail="Invalid date")
+    #First part: validating the week with a constant number of queries, whatever the number of projects
+    weeks = [SchemaRecordWeek(record=record, record_projects=record_projects)]
+    errors = await validate_weeks(session, weeks)
+    if errors:
+        raise HTTPException(status_code=errors[0]["status_code"], detail=errors[0]["detail"])
 
-    #First part: defining class record
-    if not db.session.query(ModelHoursUser).filter(ModelHoursUser.id == record.user_id).first():
-            raise HTTPException(status_code=400, detail="User not found")
-        
-    existing_record = db.session.query(ModelRecord).filter(
-        ModelRecord.user_id == record.user_id,
-        ModelRecord.date_rec == record.date_rec).first()
-           
-    if existing_record:
-        raise HTTPException(status_code=409, detail="Record already exists")
+    #Second part: writing the record, its projects and the phase hours in bulk
+    await write_weeks(session, weeks)
 
-    db_record = ModelRecord(
-            user_id = record.user_id,
-            comment = record.comment,
-            date_rec = record.date_rec
-        )
-    
-    #Second part: adding the project to the created record
-    db_projects = []
-    hourcount = 0.0
-    
-    for record_project in record_projects:
-      
-        if not project_exists(record_project.project_id):
-            raise HTTPException(status_code=404,detail="Project not found")
-        
-        existing_project = db.session.query(ModelRecordProjects).filter(
-            ModelRecordProjects.user_id == record.user_id,
-            ModelRecordProjects.date_rec == record.date_rec,
-            ModelRecordProjects.project_id == record_project.project_id
-        ).first()
+    await session.commit()
+    return {"message": "Record created successfully."}
 
-        if existing_project:
-            raise HTTPException(status_code=409, detail="User has already filled hours for this project in this week")
 
-        if not record_project.declared_hours == 0.0:
-            db_project = ModelRecordProjects(
-                user_id = record.user_id,
-                date_rec = record.date_rec,
-                project_id = record_project.project_id,
-                declared_hours = record_project.declared_hours,
-                domain = record_project.domain
-            )
-            db_projects.append(db_project)
+# 1.3.1 Insert several records
+@app.post("/api/records/batch")
+async def insert_records(weeks: List[SchemaRecordWeek], all_or_nothing: bool = False, user: SchemaHoursUserBase = Depends(get_user), session: AsyncSession = Depends(get_async_db)):
 
-            searchedPhase=db.session.query(ModelProjectPhase).filter(
-                ModelProjectPhase.project_id == record_project.project_id,
-                ModelProjectPhase.start_date <= record.date_rec,
-                ModelProjectPhase.end_date >= record.date_rec).first()
-            
-            if searchedPhase:
-                searchedPhase.hours += Decimal(record_project.declared_hours)
+    userID = await get_user_ID(user)
 
-            
-        
-        hourcount += record_project.declared_hours
-   
-    if hourcount != 35.0:
-            raise HTTPException(status_code=400,detail="Hour count does not match required value")
-    
-    date_init = record.date_rec - datetime.timedelta(days=4)
+    if not all(str(week.record.user_id) == userID for week in weeks):
+        raise HTTPException(status_code=401, detail="Unauthorized access")
 
-    searched_records = db.session.query(ModelBufferDailyRegister).filter(
-        ModelBufferDailyRegister.user_id == record.user_id,
-        ModelBufferDailyRegister.day_date.between(date_init, record.date_rec)
-        ).all()
-    
-    for buffer_record in searched_records:
-        db.session.delete(buffer_record)
+    if not weeks:
+        return {"created": [], "errors": []}
 
- 
-    db.session.add_all(db_projects)
-    db.session.add(db_record)
-    db.session.commit()
-    return {"message": "Record created successfully."}
+    # Same rules as 1.3 for every week, checked together. The valid weeks are written in one transaction,
+    # unless all_or_nothing is set and one of the weeks is invalid
+    errors = await validate_weeks(session, weeks)
+    if errors and all_or_nothing:
+        raise HTTPException(status_code=400, detail=errors)
+
+    failed = {error["index"] for error in errors}
+    valid_weeks = [week for index, week in enumerate(weeks) if index not in failed]
+    if valid_weeks:
+        await write_weeks(session, valid_weeks)
+        await session.commit()
+
+    return {"created": [week.record.date_rec for week in valid_weeks],
+            "errors": errors}
 
 
 # 1.4 Get record
 @app.get("/api/records/{hours_user_id}")
-async def get_records(hours_user_id: int, user: SchemaHoursUserBase = Depends(get_user)):
-    
-    ans = []
-
-    if not db.session.query(ModelHoursUser).filter(ModelHoursUser.id == hours_user_id).first():
-        raise HTTPException(status_code=400, detail="User not found")
-    
+async def get_records(hours_user_id: int,
+        response: Response,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        before: Optional[date] = None,
+        limit: Optional[int] = None,
+        user: SchemaHoursUserBase = Depends(get_user),
+        session: AsyncSession = Depends(get_async_db)):
+    
+    # Records are returned newest first. With a limit, the X-Next-Before header gives the value of
+    # "before" for the next page (keyset pagination on date_rec), it is absent on the last page
     userID = await get_user_ID(user)
     
     if not str(hours_user_id) == userID:
+        if not await session.get(ModelHoursUser, hours_user_id):
+            raise HTTPException(status_code=400, detail="User not found")
         raise HTTPException(status_code=401, detail="Unauthorized access")
 
-    user_declaredrecords = db.session.query(ModelRecord).filter(
-        ModelRecord.user_id == hours_user_id).order_by(desc(ModelRecord.date_rec)).all()
-    
-    for record in user_declaredrecords:
-        rec_projects = []
-
-        record_projects = db.session.query(ModelRecordProjects).filter(ModelRecordProjects.user_id == hours_user_id,
-                                                                       ModelRecordProjects.date_rec == record.date_rec,
-                                                                       ModelRecordProjects.declared_hours != 0,
-                                                                       ).all()
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail="Invalid limit")
+
+    records = select(ModelRecord).filter(ModelRecord.user_id == hours_user_id)
+    if date_from is not None:
+        records = records.filter(ModelRecord.date_rec >= date_from)
+    if date_to is not None:
+        records = records.filter(ModelRecord.date_rec <= date_to)
+    if before is not None:
+        records = records.filter(ModelRecord.date_rec < before)
+    records = records.order_by(desc(ModelRecord.date_rec))
+    if limit is not None:
+        records = records.limit(limit + 1)
+    records = records.subquery()
+
+    # One query for the page: the records joined with their non empty projects
+    rows = (await session.execute(
+        select(records.c.user_id, records.c.date_rec, records.c.comment,
+               ModelRecordProjects.project_id, ModelRecordProjects.declared_hours, ModelRecordProjects.domain)
+        .outerjoin(ModelRecordProjects, and_(ModelRecordProjects.user_id == records.c.user_id,
+                                             ModelRecordProjects.date_rec == records.c.date_rec,
+                                             ModelRecordProjects.declared_hours != 0))
+        .order_by(desc(records.c.date_rec), ModelRecordProjects.id))).all()
 
-        for project in record_projects:
-            rec_proj = SchemaRecordProjects(
-                project_id= project.project_id,
-                declared_hours= project.declared_hours,
-                domain=project.domain
-            )
-            rec_projects.append(rec_proj)
-        
-        rec_ans = {"record": record,
-                   "record_projects":rec_projects}
-        ans.append(rec_ans)     
+    ans = []
+    for row in rows:
+        if not ans or ans[-1]["record"]["date_rec"] != row.date_rec:
+            ans.append({"record": {"comment": row.comment, "date_rec": row.date_rec, "user_id": row.user_id},
+                        "record_projects": []})
+        if row.project_id is not None:
+            ans[-1]["record_projects"].append(SchemaRecordProjects(project_id=row.project_id,
+                                                                   declared_hours=row.declared_hours,
+                                                                   domain=row.domain))
+
+    if limit is not None and len(ans) > limit:
+        ans = ans[:limit]
+        response.headers["X-Next-Before"] = ans[-1]["record"]["date_rec"].date().isoformat()
 
     return ans
 
 
 #1.5 Modify hours in records
 @app.put("/api/records")
-async def change_record(record:SchemaRecord, record_projects:List[SchemaRecordProjects], user: SchemaHoursUserBase = Depends(get_user)):
+async def change_record(record:SchemaRecord, record_projects:List[SchemaRecordProjects], user: SchemaHoursUserBase = Depends(get_user), session: AsyncSession = Depends(get_async_db)):
 
-    hourcount=0.0
-
-    current_record_projects = db.session.query(ModelRecordProjects).filter(
-            ModelRecordProjects.user_id == record.user_id,
-            ModelRecordProjects.date_rec == record.date_rec,
-        )
-    
-    for record_project in current_record_projects:
-        db.session.delete(record_project)
+    userID = await get_user_ID(user)
 
-    for rp in record_projects:
+    #First part: validating the week before any write
+    if not str(record.user_id) == userID:
+        raise HTTPException(status_code=401, detail="Unauthorized access")
 
-        db_rp = ModelRecordProjects(
-            user_id = record.user_id,
-            date_rec = record.date_rec,
-            project_id = rp.project_id,
-            declared_hours = rp.declared_hours,
-            domain = rp.domain
-            )
-        db.session.add(db_rp)
+    hourcount = sum(rp.declared_hours for rp in record_projects)
 
-        hourcount += rp.declared_hours
-    
     if hourcount != 35.0:
             raise HTTPException(status_code=400,detail="Hour count does not match required value")
 
+    new_projects = {}
+    for rp in record_projects:
+        if rp.project_id in new_projects:
+            raise HTTPException(status_code=400, detail="Project declared twice in the same week")
+        if not rp.declared_hours == 0.0:
+            new_projects[rp.project_id] = rp
 
-    db.session.commit()
+    if not await session.get(ModelRecord, (record.user_id, record.date_rec)):
+        raise HTTPException(status_code=404, detail="Record not found")
+
+    found_ids = set((await session.execute(select(ModelProject.id).filter(ModelProject.id.in_(new_projects.keys())))).scalars().all())
+    if len(found_ids) != len(new_projects):
+        raise HTTPException(status_code=404,detail="Project not found")
+
+    current_record_projects = (await session.execute(select(ModelRecordProjects).filter(
+            ModelRecordProjects.user_id == record.user_id,
+            ModelRecordProjects.date_rec == record.date_rec,
+        ))).scalars().all()
+
+    #Second part: diff between the stored rows and the new ones
+    to_delete = []
+    to_update = []
+    removed = []
+    added = []
+    for current in current_record_projects:
+        new = new_projects.pop(current.project_id, None)
+        if new is None or current.declared_hours == 0:
+            # Removed project, or stored row with 0 hours (not written anymore) or duplicated project
+            to_delete.append(current.id)
+            removed.append(current)
+            if new is not None:
+                new_projects[current.project_id] = new
+        elif current.declared_hours != Decimal(str(new.declared_hours)) or current.domain != new.domain:
+            to_update.append({"id": current.id, "declared_hours": new.declared_hours, "domain": new.domain})
+            removed.append(current)
+            added.append({"user_id": record.user_id, "date_rec": current.date_rec, "project_id": current.project_id,
+                          "declared_hours": new.declared_hours, "domain": new.domain})
+
+    to_insert = [{"user_id": record.user_id,
+                  "date_rec": record.date_rec,
+                  "project_id": rp.project_id,
+                  "declared_hours": rp.declared_hours,
+                  "domain": rp.domain} for rp in new_projects.values()]
+    added += to_insert
+
+    # Deltas computed before the writes, the bulk UPDATE refreshes the stored objects
+    phase_update = apply_phase_hours(phase_hours_deltas(removed, sign=-1) + phase_hours_deltas(added))
+    monthly_update = apply_monthly_hours(monthly_hours_deltas(removed, sign=-1) + monthly_hours_deltas(added))
+
+    #Third part: bulk writes and aggregates adjusted by the delta
+    if to_delete:
+        await session.execute(delete(ModelRecordProjects).filter(ModelRecordProjects.id.in_(to_delete)))
+    if to_update:
+        await session.execute(update(ModelRecordProjects), to_update)
+    if to_insert:
+        await session.execute(insert(ModelRecordProjects), to_insert)
+
+    if phase_update is not None:
+        await session.execute(phase_update)
+    if monthly_update is not None:
+        await session.execute(monthly_update)
+
+    await session.commit()
     return {"message":"Change successful"}
 
 
 # 1.6 Get projects /*/
 @app.get("/api/projects",response_model=List[SchemaProject])
-async def get_projects(user = Depends(get_user)):
-    # THE FOLLOWING LINE IS FOCAL NAIM SPECIFIC, if you want to extract the project KPI software to other organizations, please implement the function : 
-    #   filter projects which organization (entity) is one of the organization of the user. For Focal Naim, the name of organization is in email
-    
-    if (user.role == 'Business Manager'):
-        projects =db.session.query(ModelProject).all()
-    else:
-        org = []
-        if ('focal' in user.email):
-            org.append('FOCAL')
-        if ('naim' in user.email):
-            org.append('NAIM')
-        projects =db.session.query(ModelProject).filter(ModelProject.entity.in_(org)).all()
-    if not projects:
+async def get_projects(request: Request, response: Response, user = Depends(get_user), session: AsyncSession = Depends(get_async_db)):
+    # Projects are filtered on the organizations (entities) of the user, see auth_utils.user_entities
+    versions = (await session.execute(select_versions("project"))).all()
+    scope = "all" if user.role == 'Business Manager' else "+".join(user.entities)
+    not_modified = conditional_response(request, response, make_etag("projects", ["project"], versions, scope))
+    if not_modified:
+        return not_modified
+
+    # The project table is read once per version (per worker), the lists are served from project_catalog
+    version = dict(versions).get("project", 0)
+    entities = None if user.role == 'Business Manager' else user.entities
+    catalog = project_catalog.get(version, entities)
+    if catalog is None:
+        project_catalog.load(version, (await session.execute(select(ModelProject))).scalars().all())
+        catalog = project_catalog.get(version, entities)
+
+    count, body = catalog
+    if not count:
             raise HTTPException(status_code=404,detail="No projects on database")
-    return projects
+    return await encoded_response(request, body, headers=dict(response.headers))
 
 # 1.7 Define favorites /*/
 @app.post("/api/favorites",response_model=List[SchemaFavorites])
-async def define_favorites(favorites: List[SchemaFavorites], user = Depends(get_user)):
+def define_favorites(favorites: List[SchemaFavorites], user = Depends(get_user)):
     db_favorites = []
     
     for favorite in favorites:
@@ -365,16 +442,22 @@ async def define_favorites(favorites: List[SchemaFavorites], user = Depends(get_
         db_favorites.append(db_favorite)
 
     db.session.add_all(db_favorites)
+    db.session.execute(bump_versions("favorites"))
     db.session.commit()
     return db_favorites
 
 # 1.8 Get favorites /*/
 @app.get("/api/favorites/{hours_user_id}",response_model=List[int])
-async def get_favorites(hours_user_id: int , user = Depends(get_user)):
+def get_favorites(hours_user_id: int, request: Request, response: Response, user = Depends(get_user)):
 
     if not db.session.query(ModelHoursUser).filter(ModelHoursUser.id == hours_user_id).first():
         raise HTTPException(status_code=400, detail="User not found")
 
+    versions = db.session.execute(select_versions("favorites")).all()
+    not_modified = conditional_response(request, response, make_etag("favorites", ["favorites"], versions, hours_user_id))
+    if not_modified:
+        return not_modified
+
     favorites =db.session.query(ModelFavorites.project_id).filter(
         ModelFavorites.user_id == hours_user_id
     ).all()
@@ -384,7 +467,7 @@ async def get_favorites(hours_user_id: int , user = Depends(get_user)):
 
 # 1.9 Delete favorites /*/
 @app.delete("/api/favorites")
-async def delete_favorite(favorite: SchemaFavorites, user = Depends(get_user)):
+def delete_favorite(favorite: SchemaFavorites, user = Depends(get_user)):
     user_id = favorite.user_id
     project_id = favorite.project_id
 
@@ -403,12 +486,13 @@ async def delete_favorite(favorite: SchemaFavorites, user = Depends(get_user)):
         raise HTTPException(status_code=404, detail="Project not defined as favorite by user")
     
     db.session.delete(db_favorite)
+    db.session.execute(bump_versions("favorites"))
     db.session.commit()
     return {"message": "Favorite deleted"}
 
 # 1.10 Get user domain /*/
 @app.get("/api/domain/{hours_user_id}",response_model=str)
-async def get_domain(hours_user_id: int, user = Depends(get_user)):
+def get_domain(hours_user_id: int, user = Depends(get_user)):
     searched_user = db.session.query(ModelHoursUser).filter(ModelHoursUser.id == hours_user_id).first()
     
     if not searched_user:
@@ -419,7 +503,7 @@ async def get_domain(hours_user_id: int, user = Depends(get_user)):
 
 # 1.11 Update user domain /*/
 @app.put("/api/domain/{hours_user_id}")
-async def update_domain(hours_user_id: int, updated_domain: str, user = Depends(get_user)):
+def update_domain(hours_user_id: int, updated_domain: str, user = Depends(get_user)):
     
     domain_options = ['Acoustics','Tests','Hardware','Software','Mechanics','Project Management','Shop floor','General']
 
@@ -432,79 +516,113 @@ async def update_domain(hours_user_id: int, updated_domain: str, user = Depends(
         raise HTTPException(status_code=400, detail="User not found")
         
     searched_user.domain = str(updated_domain)
+    db.session.execute(bump_versions("hoursuser"))
     db.session.commit()
     return {"message": "Domain updated"}
 
 
 # 1.12 Input to buffer table /*/
 @app.post("/api/buffertable")
-async def post_hours_per_day(dailyregs: List[SchemaBufferDailyRegister], user = Depends(get_user)):
-    
-    for dailyreg in dailyregs:
-        searched_records = db.session.query(ModelBufferDailyRegister).filter(
-            ModelBufferDailyRegister.user_id == dailyreg.user_id,
-            ModelBufferDailyRegister.day_date == dailyreg.day_date,
-            ).all()
-        
-        for buffer_record in searched_records:
-            db.session.delete(buffer_record)
-    
-    for dailyreg in dailyregs:
-        if dailyreg.daily_hours > 0:
-            buffer_rec = ModelBufferDailyRegister(
-                user_id = dailyreg.user_id,
-                day_date = dailyreg.day_date,
-                project_id = dailyreg.project_id,
-                daily_hours = dailyreg.daily_hours
-            )
+async def post_hours_per_day(dailyregs: List[SchemaBufferDailyRegister], user = Depends(get_user), session: AsyncSession = Depends(get_async_db)):
 
-            db.session.add(buffer_rec)
-        
-        
-    
-    db.session.commit()
+    userID = await get_user_ID(user)
+
+    if not all(str(dailyreg.user_id) == userID for dailyreg in dailyregs):
+        raise HTTPException(status_code=401, detail="Unauthorized access")
+
+    if not dailyregs:
+        return {"status":"buffer days registered"}
+
+    # The posted days replace the stored ones. The last entry wins when a (day, project) is posted twice
+    days = {dailyreg.day_date for dailyreg in dailyregs}
+    entries = {}
+    for dailyreg in dailyregs:
+        entries[(dailyreg.day_date, dailyreg.project_id)] = dailyreg.daily_hours
+    entries = {key: hours for key, hours in entries.items() if hours > 0}
+
+    # Rows of the posted days that are not in the new grid are deleted, the others are upserted
+    stale_rows = delete(ModelBufferDailyRegister).filter(
+        ModelBufferDailyRegister.user_id == user.id,
+        ModelBufferDailyRegister.day_date.in_(days))
+    if entries:
+        stale_rows = stale_rows.filter(tuple_(ModelBufferDailyRegister.day_date, ModelBufferDailyRegister.project_id).not_in(list(entries.keys())))
+    await session.execute(stale_rows)
+
+    if entries:
+        upsert = pg_insert(ModelBufferDailyRegister).values([{"user_id": user.id,
+                                                              "day_date": day_date,
+                                                              "project_id": project_id,
+                                                              "daily_hours": hours}
+                                                             for (day_date, project_id), hours in entries.items()])
+        await session.execute(upsert.on_conflict_do_update(
+            index_elements=["user_id", "day_date", "project_id"],
+            set_={"daily_hours": upsert.excluded.daily_hours}))
+
+    await session.commit()
     return {"status":"buffer days registered"}
 
 
 # 1.13 Get buffer table records /*/
 @app.get("/api/buffertable")
-async def get_hours_per_day(hours_user_id: int, date_init: date, date_end: date, user = Depends(get_user)):
-    searched_registers = db.session.query(ModelBufferDailyRegister).filter(
+async def get_hours_per_day(hours_user_id: int, date_init: date, date_end: date, user = Depends(get_user), session: AsyncSession = Depends(get_async_db)):
+    searched_registers = (await session.execute(select(ModelBufferDailyRegister).filter(
         ModelBufferDailyRegister.user_id == hours_user_id,
         ModelBufferDailyRegister.day_date.between(date_init, date_end)
-        ).all()
+        ))).scalars().all()
 
     
     return searched_registers
 
+# 1.14 Submit the week of the buffer table /*/
+@app.post("/api/buffertable/submit")
+async def submit_buffer_week(date_rec: date, comment: Optional[str] = None, user = Depends(get_user), session: AsyncSession = Depends(get_async_db)):
+
+    # The daily hours from Monday to Friday are summed per project and recorded for the Wednesday of the week
+    # (date_rec is checked by validate_weeks), then these buffer days are deleted with the week
+    monday = date_rec - datetime.timedelta(days=2)
+    friday = date_rec + datetime.timedelta(days=2)
+
+    week_hours = (await session.execute(select(ModelBufferDailyRegister.project_id,
+                                               func.sum(ModelBufferDailyRegister.daily_hours).label("hours"))
+        .filter(ModelBufferDailyRegister.user_id == user.id,
+                ModelBufferDailyRegister.day_date.between(monday, friday))
+        .group_by(ModelBufferDailyRegister.project_id)
+        .order_by(ModelBufferDailyRegister.project_id))).all()
+
+    if not week_hours:
+        raise HTTPException(status_code=404, detail="No buffer days for this week")
+
+    record_projects = [SchemaRecordProjects(project_id=row.project_id,
+                                            declared_hours=float(row.hours),
+                                            domain=user.domain) for row in week_hours]
+    weeks = [SchemaRecordWeek(record=SchemaRecord(date_rec=date_rec, user_id=user.id, comment=comment),
+                              record_projects=record_projects)]
+
+    errors = await validate_weeks(session, weeks)
+    if errors:
+        raise HTTPException(status_code=errors[0]["status_code"], detail=errors[0]["detail"])
+
+    await write_weeks(session, weeks, buffer_days=(2, 2))
+    await session.commit()
+    return {"message": "Record created successfully.",
+            "record_projects": record_projects}
+
 # PART 2: METHODS FOR THE PROJECT MANAGER PROFILE
 #____________________________________________________________________________________________________
 
 # 2.1 Export records CSV 
 @app.post("/api/export-records-csv")
-async def export_csv(month1: Optional[int] = None,
+def export_csv(month1: Optional[int] = None,
         year1: Optional[int] = None,
         month2: Optional[int] = None,
         year2: Optional[int] = None,
-        projects: Optional[List[int]] = None):
+        projects: Optional[List[int]] = None,
+        user: SchemaHoursUserBase = Depends(require_pm)):
     
-    tempFileName='./temp/export.csv'
-
     if (month1 is None and year1 is not None) or (month1 is not None and year1 is None) or (month2 is None and year2 is not None) or (month2 is not None and year2 is None):
         raise HTTPException(status_code=400, detail="Invalid month and year input")
 
-    date_query = db.session.query(ModelRecord.date_rec).order_by(ModelRecord.date_rec)
-    dateList=[row.date_rec for row in date_query]
-    first_date=dateList[0]
-    last_date=dateList[-1]
-
-
-    projects_query = db.session.query(ModelProject.id)
-    projectList=[row.id for row in projects_query]
-    
-    if not projects:
-        projects = projectList
-
+    first_date, last_date = db.session.query(func.min(ModelRecord.date_rec), func.max(ModelRecord.date_rec)).one()
 
     if month1 and year1:
         dateM=datetime.date(year1,month1,1)
@@ -519,150 +637,49 @@ async def export_csv(month1: Optional[int] = None,
         dateM=first_date
         dateFin=last_date
 
-    result = db.session.query(ModelRecordProjects.id.label('id'),
-                        ModelProject.project_code.label('project_code'),
-                        ModelRecordProjects.date_rec.label('date'),
-                        ModelHoursUser.username.label('name'),
-                        ModelHoursUser.email.label('email'),
-                        ModelRecordProjects.domain.label('domain'),
-                           ModelRecordProjects.declared_hours.label('hours'))\
-    .join(ModelProject, ModelProject.id == ModelRecordProjects.project_id,isouter=True)\
-    .join(ModelHoursUser, ModelHoursUser.id == ModelRecordProjects.user_id,isouter=True)\
-    .filter(ModelRecordProjects.date_rec>=dateM,
-            ModelRecordProjects.date_rec<=dateFin,
-            ModelProject.id.in_(projects))\
-    .order_by(ModelProject.project_code,ModelRecordProjects.date_rec,ModelHoursUser.username)
-
-    column_names = ["project_code",
-                    "week",
-                    "year",
-                    "name",
-                    "email",
-                    "domain",
-                    "hours"]
-
-    csv_data = csv.DictWriter(open(tempFileName,"w"), fieldnames=column_names,delimiter=";")
-    csv_data.writeheader()
-    
-    for row in result:
-       
-        week=row.date.isocalendar()[1]
-        year=row.date.year
-        
-        row_data = {"project_code":row.project_code,
-            "week":week,
-            "year":year,
-            "name":row.name,
-            "email":row.email,
-            "domain":row.domain,
-            "hours":row.hours}      
-        csv_data.writerow(row_data)
-        
-
-    async with aiofiles.open(tempFileName, mode="r") as f:
-        contents = await f.read()
-
-
-    return FileResponse(tempFileName, filename=tempFileName)
+    # Without a project list, every record with a project is exported
+    if projects:
+        project_filter = ModelRecordProjects.project_id.in_(projects)
+    else:
+        project_filter = ModelRecordProjects.project_id.isnot(None)
+
+    # The columns of the file, in order. Week and year are ISO, as read by the CSV import
+    query = (select(ModelProject.project_code.label('project_code'),
+                    cast(extract('week', ModelRecordProjects.date_rec), Integer).label('week'),
+                    cast(extract('isoyear', ModelRecordProjects.date_rec), Integer).label('year'),
+                    ModelHoursUser.username.label('name'),
+                    ModelHoursUser.email.label('email'),
+                    ModelRecordProjects.domain.label('domain'),
+                    ModelRecordProjects.declared_hours.label('hours'))
+             .join(ModelProject, ModelProject.id == ModelRecordProjects.project_id, isouter=True)
+             .join(ModelHoursUser, ModelHoursUser.id == ModelRecordProjects.user_id, isouter=True)
+             .filter(project_filter)
+             .order_by(ModelProject.project_code,ModelRecordProjects.date_rec,ModelHoursUser.username))
+    # Without records nor months, the bounds are None and the file only has its header
+    if dateM is not None:
+        query = query.filter(ModelRecordProjects.date_rec>=dateM)
+    if dateFin is not None:
+        query = query.filter(ModelRecordProjects.date_rec<=dateFin)
+
+    return csv_response(csv_chunks(query), "export.csv")
 
 # 2.2 Import records CSV
 @app.post("/api/import-csv")
-async def import_csv(file: UploadFile = File(...)):
-    
-    
+async def import_csv(file: UploadFile = File(...), user: SchemaHoursUserBase = Depends(require_pm)):
 
+    # Parsed by chunks out of the event loop, the rows are written by batches as they are parsed (see imports.py)
     try:
+        records_import = await run_in_threadpool(run_import, RecordsImport, db.session.connection(), file.file)
+    except ImportFileError as e:
+        db.session.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
 
-        contents = await file.read()
-        csv_data = csv.DictReader(contents.decode("utf-8").splitlines(),delimiter=";")
-        hoursRecords={}
-
-        for row in csv_data:
-            project_code = str(row['project_code'])
-            week = int(row['week'])
-            year = int(row['year'])
-            name = str(row['name'])
-            email = str(row['email'])
-            domain = str(row['domain'])
-            hours = float(row['hours'])
-
-            
-
-            date_rec = datetime.date.fromisocalendar(year,week,3)
-            
-            searched_user = db.session.query(ModelHoursUser).filter(
-                                            ModelHoursUser.email == email).first()
-            
-            if not searched_user:
-                raise HTTPException(status_code=400, detail="User "+ name + " not found")
-            
-            user_id = getattr(searched_user,"id")
-            
-            searched_project = db.session.query(ModelProject).filter(
-                                            ModelProject.project_code == project_code).first()
-            
-            if not searched_project:
-                raise HTTPException(status_code=400, detail="Project "+ project_code + " not found")
-            
-
-            project_id = getattr(searched_project,"id")
-            
-            
-            
-            
-            recordkey = str(date_rec)+str(user_id)
-
-
+    if records_import.error_count:
+        db.session.rollback()
+        raise HTTPException(status_code=400, detail=records_import.error_detail())
 
-            record_exists = db.session.query(ModelRecord).filter(
-                                            ModelRecord.user_id == user_id,
-                                            ModelRecord.date_rec == date_rec).first()
-
-                        
-                
-            if not record_exists:
-                new_record = ModelRecord(
-                user_id = user_id,
-                date_rec = date_rec,
-                )
-                    
-                db.session.add(new_record)
-                hoursRecords[recordkey]=hours
-
-            else:
-                if recordkey not in hoursRecords:
-                    
-                    existing_record_projects=db.session.query(ModelRecordProjects).filter(
-                                            ModelRecordProjects.user_id == user_id,
-                                            ModelRecordProjects.date_rec == date_rec).all()
-                    for rp in existing_record_projects:
-                        db.session.delete(rp)
-                    hoursRecords[recordkey]=hours
-                else:
-                    hoursRecords[recordkey]+=hours
-
-            
-            new_record_project = ModelRecordProjects(
-                        user_id = user_id,
-                        date_rec = date_rec,
-                        project_id = project_id,
-                        domain = domain,
-                        declared_hours = hours)
-            
-                
-                
-            db.session.add(new_record_project)
-        
-        all_lower = all(value == 35 for value in hoursRecords.values())
-        
-        if not all_lower:
-            raise HTTPException(status_code=400, detail="Some lines do not sum 35 hours per week. Please check your input")
-        
-        
-        db.session.commit()
-        return {"message": "Import successful."}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail="Invalid input, please try again")
+    db.session.commit()
+    return {"message": "Import successful."}
 
 
     
@@ -670,7 +687,7 @@ async def import_csv(file: UploadFile = File(...)):
     
 # 2.3 Add project
 @app.post("/api/project")
-async def add_project(project: SchemaProject, phases: List[SchemaProjectPhase], project_monthly_information: List[SchemaProjectMonthlyInformation], user = Depends(get_user)):
+def add_project(project: SchemaProject, phases: List[SchemaProjectPhase], project_monthly_information: List[SchemaProjectMonthlyInformation], user = Depends(require_pm)):
 
     existing_code = db.session.query(ModelProject).filter(ModelProject.project_code == project.project_code).first() 
     
@@ -704,7 +721,8 @@ async def add_project(project: SchemaProject, phases: List[SchemaProjectPhase],
             project_id = projectid,
             project_phase = phase.project_phase,
             start_date = phase.start_date,
-            end_date = phase.end_date
+            end_date = phase.end_date,
+            hours = 0
             )
         
         db.session.add(db_phase)
@@ -723,19 +741,23 @@ async def add_project(project: SchemaProject, phases: List[SchemaProjectPhase],
             )
         db.session.add(db_project_monthly_info)
 
+    db.session.execute(bump_versions("project", "project_monthly_information"))
     db.session.commit()
+    project_catalog.invalidate()
     
     return {'message: Project with phases added successfully'}
 
 # 2.3 Change project state
 @app.put("/api/project/change_state")
-async def change_project_state(project_id: int, status: str):
+def change_project_state(project_id: int, status: str, user = Depends(require_pm)):
 
     edited_project = db.session.query(ModelProject).filter(ModelProject.id == project_id).first() 
     if not edited_project:
         raise HTTPException(status_code=400, detail="Project id doesn't exist")
     edited_project.status = status
+    db.session.execute(bump_versions("project"))
     db.session.commit()
+    project_catalog.invalidate()
 
     return {'message: Project state successfully updated'}
 
@@ -744,7 +766,7 @@ getprojectmodel={'project': SchemaProject,
 
 # 2.4 Get project /*/
 @app.get("/api/project")
-async def get_project_with_phases(projectcode: str, user = Depends(get_user)):
+def get_project_with_phases(projectcode: str, user = Depends(require_pm)):
     
     modelproject =db.session.query(ModelProject).filter(
         ModelProject.project_code == projectcode
@@ -814,7 +836,7 @@ async def get_project_with_phases(projectcode: str, user = Depends(get_user)):
 
 # 2.5 Modify project
 @app.put("/api/project")
-async def update_project(project: SchemaProject, phases: List[SchemaProjectPhase], monthly_informations: List[SchemaProjectMonthlyInformation], user = Depends(get_user)):
+def update_project(project: SchemaProject, phases: List[SchemaProjectPhase], monthly_informations: List[SchemaProjectMonthlyInformation], user = Depends(require_pm)):
            
     searched_project = db.session.query(ModelProject).filter(ModelProject.id == project.id).first()
 
@@ -840,8 +862,10 @@ async def update_project(project: SchemaProject, phases: List[SchemaProjectPhase
     searched_project.end_cap_date = project.end_cap_date
     searched_project.start_date = project.start_date
     searched_project.end_date = project.end_date
+    db.session.execute(bump_versions("project"))
         
     db.session.commit()
+    project_catalog.invalidate()
 
 
     searched_phases = db.session.query(ModelProjectPhase).filter(
@@ -865,7 +889,9 @@ async def update_project(project: SchemaProject, phases: List[SchemaProjectPhase
     
     db.session.commit()
 
-    update_project_phase_hours(project.id)
+    # The phase dates may have changed, rebuild the hours of the project phases
+    db.session.execute(recompute_phase_hours([project.id]))
+    db.session.commit()
 
     searched_p_m_infos = db.session.query(ModelProjectMonthlyInformation).filter(
         ModelProjectMonthlyInformation.project_id == project.id)
@@ -889,6 +915,7 @@ async def update_project(project: SchemaProject, phases: List[SchemaProjectPhase
     
         db.session.add(db_p_m_info)
     
+    db.session.execute(bump_versions("project_monthly_information"))
     db.session.commit()
 
 
@@ -897,13 +924,10 @@ async def update_project(project: SchemaProject, phases: List[SchemaProjectPhase
 
 # 2.6 Delete project
 @app.delete("/api/project")
-async def delete_project(project_code: str, user: SchemaHoursUserBase = Depends(get_user)):
+def delete_project(project_code: str, user: SchemaHoursUserBase = Depends(require_pm)):
       
     project_id = getattr(db.session.query(ModelProject).filter(ModelProject.project_code==project_code).first(),"id")
     
-    if not validateManagers(False,user):
-        raise HTTPException(status_code=401, detail="Unauthorized access")
-    
     searched_project = db.session.query(ModelProject).filter(ModelProject.id == project_id).first()
     
     if not searched_project:
@@ -929,8 +953,10 @@ async def delete_project(project_code: str, user: SchemaHoursUserBase = Depends(
             db.session.commit()
 
         db.session.delete(searched_project)
+        db.session.execute(bump_versions("project", "project_monthly_information"))
         message="Project deleted."
         db.session.commit()
+        project_catalog.invalidate()
 
 
     
@@ -948,7 +974,8 @@ async def kpi_piedomainhours( project_id: int,
         year1: Optional[int] = None,
         month2: Optional[int] = None,
         year2: Optional[int] = None,
-        user: SchemaHoursUserBase = Depends(get_user)
+        user: SchemaHoursUserBase = Depends(require_pm),
+        session: AsyncSession = Depends(get_async_db)
     ):
     
     start_date = None
@@ -964,34 +991,15 @@ async def kpi_piedomainhours( project_id: int,
             end_date = datetime.date(year2, month2 + 1, 1)
 
 
+    query = (select(ModelRecordProjects.domain,func.sum(ModelRecordProjects.declared_hours))
+              .filter(ModelRecordProjects.project_id == project_id)
+              .group_by(ModelRecordProjects.domain))
     if start_date:
-        if end_date:
-            result = (db.session.query(ModelRecordProjects.domain,func.sum(ModelRecordProjects.declared_hours))
-              .filter(
-            ModelRecordProjects.project_id == project_id,
-            ModelRecordProjects.date_rec >= start_date,
-            ModelRecordProjects.date_rec < end_date
-            ).group_by(ModelRecordProjects.domain))
-        else:
-            (db.session.query(ModelRecordProjects.domain,func.sum(ModelRecordProjects.declared_hours))
-              .filter(
-            ModelRecordProjects.project_id == project_id,
-            ModelRecordProjects.date_rec >= start_date,
-            )
-            .group_by(ModelRecordProjects.domain))
-    elif end_date:
-        result = (db.session.query(ModelRecordProjects.domain,func.sum(ModelRecordProjects.declared_hours))
-              .filter(
-            ModelRecordProjects.project_id == project_id,
-            ModelRecordProjects.date_rec < end_date
-            )
-            .group_by(ModelRecordProjects.domain))
-    else:
-        result = (db.session.query(ModelRecordProjects.domain,func.sum(ModelRecordProjects.declared_hours))
-              .filter(
-            ModelRecordProjects.project_id == project_id
-            )
-            .group_by(ModelRecordProjects.domain))
+        query = query.filter(ModelRecordProjects.date_rec >= start_date)
+    if end_date:
+        query = query.filter(ModelRecordProjects.date_rec < end_date)
+
+    result = (await session.execute(query)).all()
     
     
     
@@ -1029,29 +1037,32 @@ async def kpi_linehours(
         year1: Optional[int] = None,
         month2: Optional[int] = None,
         year2: Optional[int] = None,
-        user: SchemaHoursUserBase = Depends(get_user)
+        user: SchemaHoursUserBase = Depends(require_pm),
+        session: AsyncSession = Depends(get_async_db)
     ):
     
     # Get every month where there is info about forecast
     # The forecast hours must be a successive array of months
-    hours_and_forecast_query = db.session.query(
+    hours_and_forecast_query = (await session.execute(select(
         ModelProjectMonthlyInformation.month.label('month'),
         ModelProjectMonthlyInformation.forecast_hours.label('forecast_hours'),
-        ModelMonthlyModifiedHours.total_hours.label('hours')
-    ).outerjoin(ModelMonthlyModifiedHours, ModelMonthlyModifiedHours.month == ModelProjectMonthlyInformation.month
+        func.coalesce(func.sum(ModelMonthlyModifiedHours.total_hours), 0).label('hours')
+    ).outerjoin(ModelMonthlyModifiedHours, and_(ModelMonthlyModifiedHours.month == ModelProjectMonthlyInformation.month,
+                                                ModelMonthlyModifiedHours.project_id == ModelProjectMonthlyInformation.project_id)
            ).filter(
-            ModelProjectMonthlyInformation.project_id == project_id).all()
+            ModelProjectMonthlyInformation.project_id == project_id
+           ).group_by(ModelProjectMonthlyInformation.month, ModelProjectMonthlyInformation.forecast_hours
+           ).order_by(ModelProjectMonthlyInformation.month))).all()
 
     # First date last date calculus
     months=[]
     hours=[]
     forecast_hours=[]
     for row in hours_and_forecast_query:
-        hours.append(row.month)
-        forecast_hours.append(row.forecast_hours)
+        hours.append(row.hours)
+        forecast_hours.append(row.forecast_hours or 0)
         months.append(row.month)
     # Convert the result into a list of dictionaries    
-    print(hours)
     converted_hours = hours.copy()
     converted_forecast_hours = forecast_hours.copy()
 
@@ -1123,7 +1134,8 @@ async def kpi_linehours(
 async def kpi_stackedbar(        
         project_id: int,
         unit: str,
-        user: SchemaHoursUserBase = Depends(get_user)
+        user: SchemaHoursUserBase = Depends(require_pm),
+        session: AsyncSession = Depends(get_async_db)
     ):
 
     
@@ -1137,16 +1149,16 @@ async def kpi_stackedbar(
         if not unit=='h':
             raise HTTPException(status_code=401, detail="Invalid units")
         
-    result = (
-        db.session.query(
+    result = (await session.execute(
+        select(
             ModelProjectPhase.project_phase,ModelProjectPhase.hours
-        ).filter(ModelProjectPhase.project_id == project_id).all()
-        )
+        ).filter(ModelProjectPhase.project_id == project_id)
+        )).all()
 
     for res in result:
                        
         to_add={
-            "data": [round(res.hours/factor,2)],
+            "data": [round((res.hours or 0)/factor,2)],
             "name": res.project_phase,
             "type": "bar"
         }
@@ -1163,27 +1175,24 @@ async def kpi_stackedbar(
 
 #2.10 See data
 @app.post("/api/data")
-async def see_data(month1: Optional[int] = None,
+async def see_data(request: Request,
+        month1: Optional[int] = None,
         year1: Optional[int] = None,
         month2: Optional[int] = None,
         year2: Optional[int] = None,
         projects: Optional[List[int]] = None,
-        user: SchemaHoursUserBase = Depends(get_user)):
+        user: SchemaHoursUserBase = Depends(require_pm),
+        session: AsyncSession = Depends(get_async_db)):
     
     if (month1 is None and year1 is not None) or (month1 is not None and year1 is None) or (month2 is None and year2 is not None) or (month2 is not None and year2 is None):
         raise HTTPException(status_code=400, detail="Invalid month and year input")
 
-    date_query = db.session.query(ModelRecord.date_rec).order_by(ModelRecord.date_rec)
-    dateList=[row.date_rec for row in date_query]
-    first_date=dateList[0]
-    last_date=dateList[-1]
+    first_date, last_date = (await session.execute(select(func.min(ModelRecord.date_rec), func.max(ModelRecord.date_rec)))).one()
+    if first_date is None:
+        return await json_response(request, [])
 
-
-    projects_query = db.session.query(ModelProject.id)
-    projectList=[row.id for row in projects_query]
-    
     if not projects:
-        projects = projectList
+        projects = (await session.execute(select(ModelProject.id))).scalars().all()
 
 
     if month1 and year1:
@@ -1203,7 +1212,7 @@ async def see_data(month1: Optional[int] = None,
 
 
 
-    query = db.session.query(ModelRecordProjects.id.label('id'),
+    query = select(ModelRecordProjects.id.label('id'),
                         ModelProject.project_code.label('project_code'),
                         ModelRecordProjects.date_rec.label('date'),
                         ModelHoursUser.username.label('name'),
@@ -1216,7 +1225,7 @@ async def see_data(month1: Optional[int] = None,
             ModelProject.id.in_(projects))\
     .order_by(ModelProject.project_code,ModelRecordProjects.date_rec,ModelHoursUser.username)
 
-    for row in query:
+    for row in (await session.execute(query)).all():
         
         week=row.date.isocalendar()[1]
         year=row.date.year
@@ -1233,18 +1242,22 @@ async def see_data(month1: Optional[int] = None,
         
         ans.append(db_row)
 
-    return ans
+    return await json_response(request, ans)
 
 
 #2.11 Export projects
 @app.get("/api/projects/export")
-async def get_projects():
+async def get_projects(user: SchemaHoursUserBase = Depends(require_pm)):
+    # Out of the event loop. POST /api/jobs/projects-export runs it in the background
+    return await workbook_response(write_projects_workbook, db.session, "projects_export.xlsx")
+
+def write_projects_workbook(session, filename):
     wb = openpyxl.Workbook()
     organizations = os.environ['ORGANIZATIONS'].split(',')
     widths = [3,13,13,13,13,13,40,10]
     for org in organizations:
         ws = wb.create_sheet(org) 
-        modelprojects =db.session.query(ModelProject)
+        modelprojects =session.query(ModelProject)
         ws.append([])
         ws.append([None,'Project Code','Division','Sub category','Classification','Expansion/Renewal','Project name','Status'])
         i = 0
@@ -1261,9 +1274,7 @@ async def get_projects():
         tab.tableStyleInfo = style
         ws.add_table(tab)
     del wb['Sheet']
-    temp_filename = "./temp/projects_export.xlsx"
-    wb.save(filename=temp_filename)
-    return FileResponse(temp_filename, filename=temp_filename)
+    wb.save(filename=filename)
 
 
 # PART 3: METHODS FOR THE BUSINESS MANAGER PROFILE
@@ -1271,53 +1282,42 @@ async def get_projects():
 
 #3.1. Get monthly hours
 @app.get("/api/monthlyhours",response_model=List[SchemaMonthlyModifiedHours])
-async def get_monthly_hours(month:int, year:int, user: SchemaHoursUserBase = Depends(get_user)):
-    
-    
-    response=[]
-    # Get the current date and time
+async def get_monthly_hours(month:int, year:int, request: Request, user: SchemaHoursUserBase = Depends(require_bm),
+                            session: AsyncSession = Depends(get_async_db)):
     
     dateM=datetime.date(year,month,1)
 
-    # Get users who have filled there hours for the current month
-    filtered_users=db.session.query(ModelMonthlyModifiedHours.user_id).filter(ModelMonthlyModifiedHours.month == dateM).distinct().all()
-    
-    for user in filtered_users:
-        
-        
-        username = getattr(db.session.query(ModelHoursUser).filter(ModelHoursUser.id == user.user_id).first(),"username")
-        tothours=0.0
-        hourslist=[]
-        dom="General"
-
-        # Get monthly records
-        records_with_user=db.session.query(ModelMonthlyModifiedHours).filter(ModelMonthlyModifiedHours.month == dateM,
-                                                                             ModelMonthlyModifiedHours.user_id == user.user_id)
-
-        # Get monthly records
-        for record in records_with_user:
-            if record.total_hours:
-                tothours = record.total_hours
-            if not record.total_hours == 0:
-                proj={"project_id":record.project_id,
-                    "hours":record.total_hours,
-                    "domain": record.domain}
-                hourslist.append(proj)
-
-        if tothours != 0.0:
-            sch=SchemaMonthlyModifiedHours(
-                user_id=user.user_id,
-                user_name=username,
-                hours=hourslist
-            )
-            response.append(sch)
-
-    return response
+    # The modified hours of the month with the name of their user, in one query
+    rows = (await session.execute(select(ModelMonthlyModifiedHours.user_id,
+                                         ModelHoursUser.username,
+                                         ModelMonthlyModifiedHours.project_id,
+                                         ModelMonthlyModifiedHours.total_hours,
+                                         ModelMonthlyModifiedHours.domain)
+        .join(ModelHoursUser, ModelHoursUser.id == ModelMonthlyModifiedHours.user_id)
+        .filter(ModelMonthlyModifiedHours.month == dateM)
+        .order_by(ModelMonthlyModifiedHours.user_id, ModelMonthlyModifiedHours.project_id,
+                  ModelMonthlyModifiedHours.domain))).all()
+
+    usernames={}
+    hourslists={}
+    for row in rows:
+        usernames[row.user_id]=row.username
+        hourslist=hourslists.setdefault(row.user_id, [])
+        if not row.total_hours == 0:
+            hourslist.append({"project_id":row.project_id,
+                              "hours":row.total_hours,
+                              "domain": row.domain})
+
+    # Users who have filled their hours for the month
+    response=[SchemaMonthlyModifiedHours(user_id=user_id, user_name=usernames[user_id], hours=hourslist)
+              for user_id, hourslist in hourslists.items() if any(proj["hours"] for proj in hourslist)]
+
+    return await json_response(request, response)
 
 
 #3.2. Modify monthly hours
 @app.put("/api/monthlyhours")
-async def change_monthly_hours(month:int, year:int, changed_records:SchemaMonthlyModifiedItems, user: SchemaHoursUserBase = Depends(get_user)):
+def change_monthly_hours(month:int, year:int, changed_records:SchemaMonthlyModifiedItems, user: SchemaHoursUserBase = Depends(require_bm)):
     
     dateM=datetime.date(year,month,1)
 
@@ -1361,6 +1361,7 @@ async def change_monthly_hours(month:int, year:int, changed_records:SchemaMonthl
             )
 
             db.session.add(db_monthlyhour)
+        db.session.execute(bump_versions("project_monthly_information"))
         db.session.commit()
 
     return {"message":"Monthly Hours Project modified successfully"}
@@ -1368,7 +1369,11 @@ async def change_monthly_hours(month:int, year:int, changed_records:SchemaMonthl
 
 #3.3. Reset monthly hours' table
 @app.post("/api/monthlyhours")
-async def update_monthly_hours(month:int, year:int, user: SchemaHoursUserBase = Depends(get_user)):
+async def update_monthly_hours(month:int, year:int, user: SchemaHoursUserBase = Depends(require_bm)):
+    # Out of the event loop. POST /api/jobs/monthly-hours-reset runs it in the background
+    return {"message": await run_in_threadpool(reset_monthly_hours, db.session, month, year)}
+
+def reset_monthly_hours(session, month, year):
     
     dateM=datetime.date(year,month,1)
 
@@ -1377,27 +1382,16 @@ async def update_monthly_hours(month:int, year:int, user: SchemaHoursUserBase =
     else:
         dateFin = datetime.date(year, month + 1, 1)
 
-
- 
-    existingMonthlyHours= db.session.query(ModelMonthlyModifiedHours).filter(
-        ModelMonthlyModifiedHours.month == dateM
-    ).all()
-
-    monthly_report= db.session.query(ModelMonthlyReport).filter(
+    monthly_report= session.query(ModelMonthlyReport).filter(
         ModelMonthlyReport.month == dateM
     ).first()
-    print(monthly_report.sync_date)
     if (monthly_report):
         monthly_report.sync_date = datetime.datetime.now()
-        db.session.commit()
 
-    if existingMonthlyHours:
-        for rec in existingMonthlyHours:
-            db.session.delete(rec)
-            db.session.commit()
-    
+    # Deleted and rebuilt in one transaction, the month is never read half reset
+    session.execute(delete(ModelMonthlyModifiedHours).where(ModelMonthlyModifiedHours.month == dateM))
     
-    subquery = db.session.query(
+    subquery = session.query(
         ModelRecordProjects.user_id,
         ModelRecordProjects.project_id,
         ModelRecordProjects.domain,
@@ -1421,22 +1415,16 @@ async def update_monthly_hours(month:int, year:int, user: SchemaHoursUserBase =
         func.date_trunc('month', dateM)
     ).all()
     
-    
-    
-    for row in subquery:
-        
-        db_monthlyhour = ModelMonthlyModifiedHours(
+    session.add_all([ModelMonthlyModifiedHours(
                 user_id = row.user_id,
                 project_id = row.project_id,
                 month = dateM,
                 total_hours = row.total_hours,
                 domain = row.domain
-                )
-        db.session.add(db_monthlyhour)
-        db.session.commit()
+                ) for row in subquery])
+    session.commit()
 
-  
-    return {"message":"Table updated successfully"}
+    return "Table updated successfully"
 
 
 
@@ -1449,15 +1437,16 @@ async def businesskpi_piecapsummary(
         year1: Optional[int] = None,
         month2: Optional[int] = None,
         year2: Optional[int] = None,
-        user: SchemaHoursUserBase = Depends(get_user)):
+        user: SchemaHoursUserBase = Depends(require_bm),
+        session: AsyncSession = Depends(get_async_db)):
     
     if (month1 is None and year1 is not None) or (month1 is not None and year1 is None) or (month2 is None and year2 is not None) or (month2 is not None and year2 is None):
         raise HTTPException(status_code=400, detail="Invalid month and year input")
 
-    date_query = db.session.query(ModelMonthlyModifiedHours.month).order_by(ModelMonthlyModifiedHours.month)
-    dateList=[row.month for row in date_query]
-    first_date=dateList[0]
-    last_date=dateList[-1]
+    first_date, last_date = (await session.execute(select(func.min(ModelMonthlyModifiedHours.month),
+                                                          func.max(ModelMonthlyModifiedHours.month)))).one()
+    if first_date is None:
+        raise HTTPException(status_code=404, detail="No monthly hours on database")
 
     if month1 and year1:
         dateM=datetime.date(year1,month1,1)
@@ -1474,7 +1463,7 @@ async def businesskpi_piecapsummary(
         
     #Capitalized
     
-    cap_table_by_division= db.session.query(ModelProject.division, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    cap_table_by_division= (await session.execute(select(ModelProject.division, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelMonthlyModifiedHours, ModelProject.id == ModelMonthlyModifiedHours.project_id, isouter=True)\
     .filter(ModelMonthlyModifiedHours.month >= dateM,
             ModelMonthlyModifiedHours.month <= dateFin,
@@ -1489,18 +1478,15 @@ async def businesskpi_piecapsummary(
                     or_(ModelProject.end_cap_date.is_(None), ModelProject.end_cap_date > dateM))))\
     .group_by(ModelProject.division) \
     .having(func.sum(ModelMonthlyModifiedHours.total_hours) != 0) \
-    .order_by(func.sum(ModelMonthlyModifiedHours.total_hours).desc())
-
-    if not cap_table_by_division:
-        raise HTTPException(status_code=400, detail="Invalid month and year input")
+    .order_by(func.sum(ModelMonthlyModifiedHours.total_hours).desc()))).all()
 
     tot_cap_hours=sum([row.hours for row in cap_table_by_division])
 
-    tot_hours_query= db.session.query(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    tot_hours_query= (await session.execute(select(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
     .filter(ModelMonthlyModifiedHours.month >= dateM,
             ModelMonthlyModifiedHours.month <= dateFin,
-            ModelProject.sub_category != 'ABS').first()
+            ModelProject.sub_category != 'ABS'))).first()
     
     tot_hours = tot_hours_query.hours
     
@@ -1537,20 +1523,20 @@ async def businesskpi_piecapsummary(
 
         data2.append(db_cap)
 
-    FCS_hours_query= db.session.query(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    FCS_hours_query= (await session.execute(select(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
     .filter(ModelMonthlyModifiedHours.month >= dateM,
             ModelMonthlyModifiedHours.month <= dateFin,
-            ModelProject.project_code == 'FCS').first()
+            ModelProject.project_code == 'FCS'))).first()
 
     FCS_hours = FCS_hours_query.hours
 
-    other_hours_query= db.session.query(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    other_hours_query= (await session.execute(select(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
     .filter(ModelMonthlyModifiedHours.month >= dateM,
             ModelMonthlyModifiedHours.month <= dateFin,
             ModelProject.project_code != 'FCS',
-            ModelProject.sub_category == 'ETC').first()
+            ModelProject.sub_category == 'ETC'))).first()
 
     other_hours = other_hours_query.hours
 
@@ -1597,16 +1583,17 @@ async def businesskpi_barcapsummary(
         year1: Optional[int] = None,
         month2: Optional[int] = None,
         year2: Optional[int] = None,
-        user: SchemaHoursUserBase = Depends(get_user)):
+        user: SchemaHoursUserBase = Depends(require_bm),
+        session: AsyncSession = Depends(get_async_db)):
     
 
     if (month1 is None and year1 is not None) or (month1 is not None and year1 is None) or (month2 is None and year2 is not None) or (month2 is not None and year2 is None):
         raise HTTPException(status_code=400, detail="Invalid month and year input")
 
-    date_query = db.session.query(ModelMonthlyModifiedHours.month).order_by(ModelMonthlyModifiedHours.month)
-    dateList=[row.month for row in date_query]
-    first_date=dateList[0]
-    last_date=dateList[-1]
+    first_date, last_date = (await session.execute(select(func.min(ModelMonthlyModifiedHours.month),
+                                                          func.max(ModelMonthlyModifiedHours.month)))).one()
+    if first_date is None:
+        raise HTTPException(status_code=404, detail="No monthly hours on database")
 
     if month1 and year1:
         dateM=datetime.date(year1,month1,1)
@@ -1627,7 +1614,7 @@ async def businesskpi_barcapsummary(
     
     ans=[]
 
-    cap_table_by_subcategory= db.session.query(ModelProject.sub_category, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    cap_table_by_subcategory= (await session.execute(select(ModelProject.sub_category, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelMonthlyModifiedHours, ModelProject.id == ModelMonthlyModifiedHours.project_id, isouter=True)\
     .filter(ModelMonthlyModifiedHours.month >= dateM,
             ModelMonthlyModifiedHours.month <= dateFin,
@@ -1642,16 +1629,16 @@ async def businesskpi_barcapsummary(
                     or_(ModelProject.end_cap_date.is_(None), ModelProject.end_cap_date > dateM)))) \
     .group_by(ModelProject.sub_category) \
     .having(func.sum(ModelMonthlyModifiedHours.total_hours) != 0) \
-    .order_by(func.sum(ModelMonthlyModifiedHours.total_hours).desc())
+    .order_by(func.sum(ModelMonthlyModifiedHours.total_hours).desc()))).all()
 
-    tot_table_by_subcategory= db.session.query(ModelProject.sub_category, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    tot_table_by_subcategory= (await session.execute(select(ModelProject.sub_category, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelMonthlyModifiedHours, ModelProject.id == ModelMonthlyModifiedHours.project_id, isouter=True)\
     .filter(ModelMonthlyModifiedHours.month >= dateM,
             ModelMonthlyModifiedHours.month <= dateFin,
             ModelProject.sub_category != 'ABS') \
     .group_by(ModelProject.sub_category) \
     .having(func.sum(ModelMonthlyModifiedHours.total_hours) != 0) \
-    .order_by(func.sum(ModelMonthlyModifiedHours.total_hours).desc())
+    .order_by(func.sum(ModelMonthlyModifiedHours.total_hours).desc()))).all()
 
     cap_subcats = [row.sub_category for row in cap_table_by_subcategory]
     tot_subcats = [row.sub_category for row in tot_table_by_subcategory]
@@ -1697,15 +1684,16 @@ async def businesskpi_linenoncapsummary(
         year1: Optional[int] = None,
         month2: Optional[int] = None,
         year2: Optional[int] = None,
-        user: SchemaHoursUserBase = Depends(get_user)):
+        user: SchemaHoursUserBase = Depends(require_bm),
+        session: AsyncSession = Depends(get_async_db)):
 
     if (month1 is None and year1 is not None) or (month1 is not None and year1 is None) or (month2 is None and year2 is not None) or (month2 is not None and year2 is None):
         raise HTTPException(status_code=400, detail="Invalid month and year input")
 
-    date_query = db.session.query(ModelMonthlyModifiedHours.month).order_by(ModelMonthlyModifiedHours.month)
-    dateList=[row.month for row in date_query]
-    first_date=dateList[0]
-    last_date=dateList[-1]
+    first_date, last_date = (await session.execute(select(func.min(ModelMonthlyModifiedHours.month),
+                                                          func.max(ModelMonthlyModifiedHours.month)))).one()
+    if first_date is None:
+        raise HTTPException(status_code=404, detail="No monthly hours on database")
 
     if month1 and year1:
         dateM=datetime.date(year1,month1,1)
@@ -1729,55 +1717,51 @@ async def businesskpi_linenoncapsummary(
         
     
 
-    FCS_hours_query = db.session.query(ModelMonthlyModifiedHours.month,func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
-        .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
+    FCS_hours_query = (await session.execute(select(ModelMonthlyModifiedHours.month,func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))
+        .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)
         .filter(ModelMonthlyModifiedHours.month >= dateM,
                 ModelMonthlyModifiedHours.month <= dateFin,
-                ModelProject.project_code == 'FCS')\
-        .group_by(ModelMonthlyModifiedHours.month)\
-        .order_by(ModelMonthlyModifiedHours.month)
+                ModelProject.project_code == 'FCS')
+        .group_by(ModelMonthlyModifiedHours.month)
+        .order_by(ModelMonthlyModifiedHours.month))).all()
     
-    ETC_hours_query = db.session.query(ModelMonthlyModifiedHours.month,func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
-        .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
+    ETC_hours_query = (await session.execute(select(ModelMonthlyModifiedHours.month,func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))
+        .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)
         .filter(ModelMonthlyModifiedHours.month >= dateM,
                 ModelMonthlyModifiedHours.month <= dateFin,
                 ModelProject.sub_category == 'ETC',
-                ModelProject.project_code != 'FCS')\
-        .group_by(ModelMonthlyModifiedHours.month)\
-        .order_by(ModelMonthlyModifiedHours.month)
+                ModelProject.project_code != 'FCS')
+        .group_by(ModelMonthlyModifiedHours.month)
+        .order_by(ModelMonthlyModifiedHours.month))).all()
     
-    TOT_hours_query = db.session.query(ModelMonthlyModifiedHours.month,func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
-        .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
+    TOT_hours_query = (await session.execute(select(ModelMonthlyModifiedHours.month,func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))
+        .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)
         .filter(ModelMonthlyModifiedHours.month >= dateM,
                 ModelMonthlyModifiedHours.month <= dateFin,
-                ModelProject.sub_category != 'ABS')\
-        .group_by(ModelMonthlyModifiedHours.month)\
-        .order_by(ModelMonthlyModifiedHours.month)
+                ModelProject.sub_category != 'ABS')
+        .group_by(ModelMonthlyModifiedHours.month)
+        .order_by(ModelMonthlyModifiedHours.month))).all()
+
+    # Capitalized hours of every month, the projects being capitalized on the month itself
+    CAP_hours_query = (await session.execute(select(ModelMonthlyModifiedHours.month,func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))
+        .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)
+        .filter(ModelMonthlyModifiedHours.month >= dateM,
+                ModelMonthlyModifiedHours.month <= dateFin,
+                ModelProject.sub_category != 'ABS',
+                and_(
+                    ModelProject.start_cap_date.isnot(None),
+                    ModelProject.start_cap_date <= ModelMonthlyModifiedHours.month,
+                    or_(ModelProject.end_cap_date.is_(None), ModelProject.end_cap_date > ModelMonthlyModifiedHours.month)))
+        .group_by(ModelMonthlyModifiedHours.month))).all()
+    cap_dict={row.month:row.hours for row in CAP_hours_query}
     
     dates=[row.month for row in FCS_hours_query]
     dataengchange=[round(row.hours/factor,2) for row in FCS_hours_query]
     
     dataetc=[round(row.hours/factor,2) for row in ETC_hours_query]
     datatot=[round(row.hours/factor,2) for row in TOT_hours_query]
-    datacap=[]
-    for date in dates:
-        
-        CAP_hours_query = db.session.query(ModelMonthlyModifiedHours.month,func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
-        .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
-        .filter(ModelMonthlyModifiedHours.month == date,
-                ModelProject.sub_category != 'ABS',
-                and_(
-                    ModelProject.start_cap_date.isnot(None),
-                    ModelProject.start_cap_date <= date,
-                    or_(ModelProject.end_cap_date.is_(None), ModelProject.end_cap_date > date)))\
-        .group_by(ModelMonthlyModifiedHours.month)\
-        .order_by(ModelMonthlyModifiedHours.month)
-        
-        datacap.append(round(row.hours/factor,2) for row in CAP_hours_query)
+    datacap=[round(cap_dict.get(date,0)/factor,2) for date in dates]
 
-    flatdatacap=[num for sublist in datacap for num in sublist]
-    datacap=flatdatacap
-    
     datanoncaptot=[a-b for a,b in zip(datatot,datacap)]
     datasum=[a+b for a,b in zip(dataetc,dataengchange)]
     datanoncap=[a-b for a,b in zip(datanoncaptot,datasum)]
@@ -1818,7 +1802,8 @@ async def businesskpi_linehours(
         year1: Optional[int] = None,
         month2: Optional[int] = None,
         year2: Optional[int] = None,
-        user: SchemaHoursUserBase = Depends(get_user)):
+        user: SchemaHoursUserBase = Depends(require_bm),
+        session: AsyncSession = Depends(get_async_db)):
     
     
     start_date = None
@@ -1834,54 +1819,20 @@ async def businesskpi_linehours(
             end_date = datetime.date(year2, month2 + 1, 1)
         
     
+    query = (
+        select(
+            ModelMonthlyModifiedHours.month.label('date'),
+            func.sum(ModelMonthlyModifiedHours.total_hours).label('hours')
+        )
+        .group_by(ModelMonthlyModifiedHours.month)
+        .order_by(ModelMonthlyModifiedHours.month)
+        )
     if start_date:
-        if end_date:
-            result = (
-            db.session.query(
-                ModelMonthlyModifiedHours.month.label('date'),
-                func.sum(ModelMonthlyModifiedHours.total_hours).label('hours')
-            )
-            .filter(ModelMonthlyModifiedHours.month >= start_date,
-                    ModelMonthlyModifiedHours.month < end_date)
-            .group_by(ModelMonthlyModifiedHours.month)
-            .order_by(ModelMonthlyModifiedHours.month)
-            .all()
-            )
-        else: 
-            result = (
-            db.session.query(
-                ModelMonthlyModifiedHours.month.label('date'),
-                func.sum(ModelMonthlyModifiedHours.total_hours).label('hours')
-            )
-            .filter(ModelMonthlyModifiedHours.month >= start_date)
-            .group_by(ModelMonthlyModifiedHours.month)
-            .order_by(ModelMonthlyModifiedHours.month)
-            .all()
-            )
-    elif end_date: result = (
-            db.session.query(
-                ModelMonthlyModifiedHours.month.label('date'),
-                func.sum(ModelMonthlyModifiedHours.total_hours).label('hours')
-            )
-            .filter(ModelMonthlyModifiedHours.month < end_date)
-            .group_by(ModelMonthlyModifiedHours.month)
-            .order_by(ModelMonthlyModifiedHours.month)
-            .all()
-            )
-    else:
-        result = (
-            db.session.query(
-                ModelMonthlyModifiedHours.month.label('date'),
-                func.sum(ModelMonthlyModifiedHours.total_hours).label('hours')
-            )
-            .group_by(ModelMonthlyModifiedHours.month)
-            .order_by(ModelMonthlyModifiedHours.month)
-            .all()
-            )
-    
-   
+        query = query.filter(ModelMonthlyModifiedHours.month >= start_date)
+    if end_date:
+        query = query.filter(ModelMonthlyModifiedHours.month < end_date)
 
-       
+    result = (await session.execute(query)).all()
 
     # Convert the result into a list of dictionaries
     dates = [row.date for row in result]
@@ -1926,7 +1877,8 @@ async def businesskpi_piedomainhours(
     year1: Optional[int] = None,
     month2: Optional[int] = None,
     year2: Optional[int] = None,
-    user: SchemaHoursUserBase = Depends(get_user)):
+    user: SchemaHoursUserBase = Depends(require_bm),
+    session: AsyncSession = Depends(get_async_db)):
 
     start_date = None
     end_date = None
@@ -1940,24 +1892,14 @@ async def businesskpi_piedomainhours(
         else:
             end_date = datetime.date(year2, month2 + 1, 1)
 
+    query = (select(ModelMonthlyModifiedHours.domain, func.sum(ModelMonthlyModifiedHours.total_hours))
+             .group_by(ModelMonthlyModifiedHours.domain))
     if start_date:
-        if end_date:
-            result = (db.session.query(ModelMonthlyModifiedHours.domain, func.sum(ModelMonthlyModifiedHours.total_hours))
-                .filter(
-                ModelMonthlyModifiedHours.month >= start_date,
-                ModelMonthlyModifiedHours.month < end_date)
-                .group_by(ModelMonthlyModifiedHours.domain).all())
-        else:
-            result = (db.session.query(ModelMonthlyModifiedHours.domain, func.sum(ModelMonthlyModifiedHours.total_hours))
-                .filter(ModelMonthlyModifiedHours.month >= start_date)
-                .group_by(ModelMonthlyModifiedHours.domain).all())
-    elif end_date:
-        result = (db.session.query(ModelMonthlyModifiedHours.domain, func.sum(ModelMonthlyModifiedHours.total_hours))
-                .filter(ModelMonthlyModifiedHours.month < end_date)
-                .group_by(ModelMonthlyModifiedHours.domain).all())
-    else:
-        result = (db.session.query(ModelMonthlyModifiedHours.domain, func.sum(ModelMonthlyModifiedHours.total_hours))
-                .group_by(ModelMonthlyModifiedHours.domain).all())
+        query = query.filter(ModelMonthlyModifiedHours.month >= start_date)
+    if end_date:
+        query = query.filter(ModelMonthlyModifiedHours.month < end_date)
+
+    result = (await session.execute(query)).all()
 
     
 
@@ -1983,9 +1925,15 @@ async def businesskpi_piedomainhours(
 
 #3.9. Get users
 @app.get("/api/getusers")
-async def get_all_users(user: SchemaHoursUserBase = Depends(get_user)):
+async def get_all_users(request: Request, response: Response, user: SchemaHoursUserBase = Depends(require_bm),
+                        session: AsyncSession = Depends(get_async_db)):
+    versions = (await session.execute(select_versions("hoursuser"))).all()
+    not_modified = conditional_response(request, response, make_etag("users", ["hoursuser"], versions))
+    if not_modified:
+        return not_modified
+
     ans=[]
-    users =db.session.query(ModelHoursUser).all()
+    users =(await session.execute(select(ModelHoursUser.username, ModelHoursUser.id, ModelHoursUser.email, ModelHoursUser.status))).all()
     if not users:
             raise HTTPException(status_code=404,detail="No users on database")
     
@@ -1997,63 +1945,39 @@ async def get_all_users(user: SchemaHoursUserBase = Depends(get_user)):
             "status": user.status}
         
         ans.append(db_user)
-    return ans
+    return await json_response(request, ans, headers=dict(response.headers))
 
 #3.10. Export monthly hours
 @app.get("/api/export_monthly")
-async def export_monthly(month:int, year:int):
+async def export_monthly(month:int, year:int, user: SchemaHoursUserBase = Depends(require_bm)):
     dateM=datetime.date(year,month,1)
 
-    temp_filename='./temp/exportModified.csv'
-
-    query = db.session.query(ModelMonthlyModifiedHours.total_hours.label('buffer'),
-                        ModelProject.project_code.label('project_code'),
-                        ModelHoursUser.username.label('name'),
-                        ModelMonthlyModifiedHours.month.label('month'),
-                        ModelMonthlyModifiedHours.domain.label('domain'),
-                        ModelMonthlyModifiedHours.total_hours.label('hours'))\
-    .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id,isouter=True)\
-    .join(ModelHoursUser, ModelHoursUser.id == ModelMonthlyModifiedHours.user_id,isouter=True)\
-    .filter(ModelMonthlyModifiedHours.month == dateM)\
-    .filter(ModelMonthlyModifiedHours.total_hours != 0)\
-        .order_by(ModelProject.project_code,ModelHoursUser.username)
-
-    if not query:
-        raise HTTPException(status_code=401, detail="No records for inputted month")
-
-    column_names = ["project_code",
-                    "name",
-                    "month",
-                    "year",
-                    "hours",
-                    "domain"]
-
-    csv_data = csv.DictWriter(open(temp_filename,"w"), fieldnames=column_names,delimiter=";")
-    csv_data.writeheader()
-    
-    for row in query:
-       
-        week=row.month.isocalendar()[1]
-        year=row.month.year
-        
-        row_data = {"project_code":row.project_code,
-            "name":row.name,
-            "month":week,
-            "year":year,
-            "hours":row.hours}      
-        csv_data.writerow(row_data)
-
-    async with aiofiles.open(temp_filename, mode="r") as f:
-        contents = await f.read()
-
-
-    return FileResponse(temp_filename, filename=temp_filename)
+    # The columns of the file, in order. The month column holds the week number of the first day of the month
+    # and the domain column is left empty, as in the first version of the file
+    query = (select(ModelProject.project_code.label('project_code'),
+                    ModelHoursUser.username.label('name'),
+                    cast(extract('week', ModelMonthlyModifiedHours.month), Integer).label('month'),
+                    cast(extract('year', ModelMonthlyModifiedHours.month), Integer).label('year'),
+                    ModelMonthlyModifiedHours.total_hours.label('hours'),
+                    null().label('domain'))
+             .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id, isouter=True)
+             .join(ModelHoursUser, ModelHoursUser.id == ModelMonthlyModifiedHours.user_id, isouter=True)
+             .filter(ModelMonthlyModifiedHours.month == dateM)
+             .filter(ModelMonthlyModifiedHours.total_hours != 0)
+             .order_by(ModelProject.project_code,ModelHoursUser.username))
+
+    return csv_response(csv_chunks(query), "exportModified.csv")
 
 #3.11. Export project capitalization summary
 @app.get("/api/export/monthly_project_capitalization")
-async def export_monthly_project_capitalization(month:int, year:int,user: SchemaHoursUserBase = Depends(get_user)):
+async def export_monthly_project_capitalization(month:int, year:int,user: SchemaHoursUserBase = Depends(require_bm)):
+    # Out of the event loop. POST /api/jobs/monthly-project-capitalization runs it in the background
+    return await workbook_response(write_capitalization_workbook, db.session, "exctest.xlsx", month, year)
+
+def write_capitalization_workbook(session, filename, month, year):
     
-    dateM=datetime.date(year,month,1)
+    # Datetime, like the capitalization dates of the projects it is compared to
+    dateM=datetime.datetime(year,month,1)
 
     wb=openpyxl.Workbook()
     sheet=wb.active
@@ -2125,7 +2049,7 @@ async def export_monthly_project_capitalization(month:int, year:int,user: Schema
     sheet.column_dimensions['K'].width = 17.91
     sheet.column_dimensions['L'].width = 17.91
     
-    table_by_project= db.session.query(ModelProject.id, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    table_by_project= session.query(ModelProject.id, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelMonthlyModifiedHours, ModelProject.id == ModelMonthlyModifiedHours.project_id, isouter=True)\
     .filter(ModelMonthlyModifiedHours.month == dateM,
                 ModelProject.sub_category != 'ABS')\
@@ -2141,7 +2065,7 @@ async def export_monthly_project_capitalization(month:int, year:int,user: Schema
     row_projects=4
     
     for row in table_by_project:
-        line=db.session.query(ModelProject).filter(ModelProject.id == row.id).first()
+        line=session.query(ModelProject).filter(ModelProject.id == row.id).first()
         
         if(
             (line.start_cap_date is not None and line.start_cap_date <= dateM and (line.end_cap_date is None or line.end_cap_date > dateM))
@@ -2157,7 +2081,7 @@ async def export_monthly_project_capitalization(month:int, year:int,user: Schema
         sheet.cell(row = row_projects, column= 6).value= float(row.hours)*float(capnum)
         row_projects+=1
     
-    cap_table_by_division= db.session.query(ModelProject.division, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    cap_table_by_division= session.query(ModelProject.division, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelMonthlyModifiedHours, ModelProject.id == ModelMonthlyModifiedHours.project_id, isouter=True)\
     .filter(ModelMonthlyModifiedHours.month == dateM,
             or_(
@@ -2193,20 +2117,20 @@ async def export_monthly_project_capitalization(month:int, year:int,user: Schema
 
     """Part 2"""
     
-    FCS_hours_query = db.session.query(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    FCS_hours_query = session.query(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
         .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
         .filter(ModelMonthlyModifiedHours.month == dateM,
                 ModelProject.project_code == 'FCS')
         
     
-    ETC_hours_query = db.session.query(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    ETC_hours_query = session.query(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
         .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
         .filter(ModelMonthlyModifiedHours.month == dateM,
                 ModelProject.sub_category == 'ETC',
                 ModelProject.project_code != 'FCS')
         
     
-    TOT_hours_query = db.session.query(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    TOT_hours_query = session.query(func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
         .join(ModelProject, ModelProject.id == ModelMonthlyModifiedHours.project_id)\
         .filter(ModelMonthlyModifiedHours.month == dateM,
                 ModelProject.sub_category != 'ABS')
@@ -2278,7 +2202,7 @@ async def export_monthly_project_capitalization(month:int, year:int,user: Schema
 
     row_other+=3
 
-    cap_table_by_subcategory= db.session.query(ModelProject.sub_category, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    cap_table_by_subcategory= session.query(ModelProject.sub_category, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelMonthlyModifiedHours, ModelProject.id == ModelMonthlyModifiedHours.project_id, isouter=True)\
     .filter(ModelMonthlyModifiedHours.month == dateM,
             or_(
@@ -2290,7 +2214,7 @@ async def export_monthly_project_capitalization(month:int, year:int,user: Schema
     .having(func.sum(ModelMonthlyModifiedHours.total_hours) != 0) \
     .order_by(func.sum(ModelMonthlyModifiedHours.total_hours).desc())
 
-    tot_table_by_subcategory= db.session.query(ModelProject.sub_category, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
+    tot_table_by_subcategory= session.query(ModelProject.sub_category, func.sum(ModelMonthlyModifiedHours.total_hours).label('hours'))\
     .join(ModelMonthlyModifiedHours, ModelProject.id == ModelMonthlyModifiedHours.project_id, isouter=True)\
     .filter(ModelMonthlyModifiedHours.month == dateM,
             ModelProject.sub_category != 'ABS') \
@@ -2354,9 +2278,39 @@ async def export_monthly_project_capitalization(month:int, year:int,user: Schema
     sheet.cell(row = row_other, column= 12).value=totsum1
     sheet.cell(row = row_other, column= 12).font=Font(bold=True)
 
-    temp_filename = "./temp/exctest.xlsx"
-    wb.save(filename=temp_filename)
-    return FileResponse(temp_filename, filename=temp_filename)
+    wb.save(filename=filename)
+
+#4. Background jobs: the long operations above, run by jobs.py. Poll the state of the job, then download its result
+@app.post("/api/jobs/projects-export", status_code=202)
+async def submit_projects_export(user: SchemaHoursUserBase = Depends(require_pm)):
+    return submit("projects-export", user.id, write_projects_workbook, filename="projects_export.xlsx")
+
+@app.post("/api/jobs/monthly-project-capitalization", status_code=202)
+async def submit_monthly_project_capitalization(month:int, year:int, user: SchemaHoursUserBase = Depends(require_bm)):
+    return submit("monthly-project-capitalization", user.id, write_capitalization_workbook,
+                  filename=f"capitalization_{year}_{month:02d}.xlsx", month=month, year=year)
+
+@app.post("/api/jobs/monthly-hours-reset", status_code=202)
+async def submit_monthly_hours_reset(month:int, year:int, user: SchemaHoursUserBase = Depends(require_bm)):
+    return submit("monthly-hours-reset", user.id, reset_monthly_hours, month=month, year=year)
+
+def user_job(job_id: str, user):
+    # The jobs of a user are only visible to this user and to the Business Managers
+    job = get_job(job_id)
+    if job is None or (job["user_id"] != user.id and user.role != "Business Manager"):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}")
+async def get_job_state(job_id: str, user: SchemaHoursUserBase = Depends(require_pm)):
+    return user_job(job_id, user)
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str, user: SchemaHoursUserBase = Depends(require_pm)):
+    job = user_job(job_id, user)
+    if job["status"] != "done" or not job["filename"]:
+        raise HTTPException(status_code=409, detail="The job has no result to download, its status is " + job["status"])
+    return FileResponse(result_path(job_id), filename=job["filename"])
 
 #___________________________________________________________________________________________
 
@@ -2365,20 +2319,78 @@ def project_exists(project_id: Union[int,str]) -> bool:
     project = db.session.query(ModelProject).get(project_id)
     return project is not None
 
-def validateManagers(BM: bool, user: SchemaHoursUserBase= Depends(get_user)):
-    usertype = getattr(db.session.query(ModelHoursUser).filter(
-        ModelHoursUser.username == user.username,
-        ModelHoursUser.email == user.email).first(),"role")
-
-    res=False
-
-    if not BM:
-        if (usertype=="Project Manager" or usertype=="Business Manager"):
-            res=True
-    else:
-        if (usertype=="Business Manager"):
-            res=True
-    return res
+async def validate_weeks(session: AsyncSession, weeks: List[SchemaRecordWeek]):
+    # Checks the weeks of one user with 3 queries, returns the errors as {"index", "date_rec", "status_code", "detail"}
+    user_id = weeks[0].record.user_id
+    dates = [week.record.date_rec for week in weeks]
+    project_ids = {rp.project_id for week in weeks for rp in week.record_projects}
+
+    existing_records = set((await session.execute(select(ModelRecord.date_rec).filter(
+        ModelRecord.user_id == user_id,
+        ModelRecord.date_rec.in_(dates)))).scalars().all())
+
+    found_ids = set((await session.execute(select(ModelProject.id).filter(ModelProject.id.in_(project_ids)))).scalars().all())
+
+    existing_projects = set((await session.execute(select(ModelRecordProjects.date_rec, ModelRecordProjects.project_id).filter(
+        ModelRecordProjects.user_id == user_id,
+        ModelRecordProjects.date_rec.in_(dates),
+        ModelRecordProjects.project_id.in_(project_ids)))).all())
+
+    existing_records = {date_rec.date() for date_rec in existing_records}
+    existing_projects = {(date_rec.date(), project_id) for date_rec, project_id in existing_projects}
+
+    errors = []
+    seen = set()
+    for index, week in enumerate(weeks):
+        date_rec = week.record.date_rec
+        week_ids = {rp.project_id for rp in week.record_projects}
+        if date_rec.weekday() != 2:
+            error = (400, "Invalid date")
+        elif date_rec in seen:
+            error = (400, "Week submitted twice")
+        elif date_rec in existing_records:
+            error = (409, "Record already exists")
+        elif not week_ids <= found_ids:
+            error = (404, "Project not found")
+        elif any((date_rec, project_id) in existing_projects for project_id in week_ids):
+            error = (409, "User has already filled hours for this project in this week")
+        elif sum(rp.declared_hours for rp in week.record_projects) != 35.0:
+            error = (400, "Hour count does not match required value")
+        else:
+            error = None
+        seen.add(date_rec)
+        if error:
+            errors.append({"index": index, "date_rec": date_rec.isoformat(), "status_code": error[0], "detail": error[1]})
+    return errors
+
+async def write_weeks(session: AsyncSession, weeks: List[SchemaRecordWeek], buffer_days=(4, 0)):
+    # Bulk inserts of the records and their projects, phase and monthly hours and buffer cleanup with one statement each.
+    # The buffer days deleted go from buffer_days[0] days before to buffer_days[1] days after the Wednesday of each week
+    db_records = [{"user_id": week.record.user_id,
+                   "comment": week.record.comment,
+                   "date_rec": week.record.date_rec} for week in weeks]
+    db_projects = [{"user_id": week.record.user_id,
+                    "date_rec": week.record.date_rec,
+                    "project_id": record_project.project_id,
+                    "declared_hours": record_project.declared_hours,
+                    "domain": record_project.domain}
+                   for week in weeks for record_project in week.record_projects if not record_project.declared_hours == 0.0]
+
+    await session.execute(insert(ModelRecord), db_records)
+    if db_projects:
+        await session.execute(insert(ModelRecordProjects), db_projects)
+        await session.execute(apply_phase_hours(phase_hours_deltas(db_projects)))
+        # A week written after the reset of its month is added to the monthly hours, like a change
+        monthly_update = apply_monthly_hours(monthly_hours_deltas(db_projects))
+        if monthly_update is not None:
+            await session.execute(monthly_update)
+
+    await session.execute(delete(ModelBufferDailyRegister).filter(
+        ModelBufferDailyRegister.user_id == weeks[0].record.user_id,
+        or_(*[ModelBufferDailyRegister.day_date.between(week.record.date_rec - datetime.timedelta(days=buffer_days[0]),
+                                                        week.record.date_rec + datetime.timedelta(days=buffer_days[1]))
+              for week in weeks])
+        ))
 
 def find_capitalization(project_phase: int):
     res = None
@@ -2406,33 +2418,6 @@ def week_in_month(month, record_date):
 
     return cond
 
-def update_project_phase_hours(project_id):
-    # Create a session to interact with the database
-    try:
-        # Query ProjectPhases for the specific project_id
-        phases = db.session.query(ModelProjectPhase).filter(ModelProjectPhase.project_id == project_id).all()
-
-        # Loop through each phase and calculate the summed hours from RecordProjects
-        for phase in phases:
-            start_date = phase.start_date
-            end_date = phase.end_date
-
-            # Query RecordProjects and sum the declared_hours within the date interval
-            total_hours = db.session.query(func.sum(ModelRecordProjects.declared_hours)).filter(
-                ModelRecordProjects.project_id == project_id,
-                ModelRecordProjects.date_rec >= start_date,
-                ModelRecordProjects.date_rec < end_date
-            ).scalar()
-
-            # Update the hours column of the ProjectPhases with the calculated total_hours
-            phase.hours = total_hours
-
-        # Commit the changes to the database
-        db.session.commit()
-
-    except Exception as e:
-        raise HTTPException(status_code=404, detail="Unable to update hours")
-
 def concatanateListswoduplicates(list1, list2):
     set1=set(list1)
     set2=set(list2)
@@ -2459,38 +2444,17 @@ def convert_to_seconddaystr(input_date):
 
 #add: change monthly hours from csv. Made for one-time convenience; no need for implementation.
 @app.put("/api/import-csv-monthly")
-async def import_csv_monthly(file: UploadFile = File(...)):
-    
-    contents = await file.read()
-    csv_data = csv.DictReader(contents.decode("utf-8").splitlines(),delimiter=";")
-    
-   
-    for row in csv_data:
-        month = int(row['month'])
-        project_code = str(row['project'])
-        hours = float(row['hours'])
-        user_id = int(row['user_id'])
+async def import_csv_monthly(file: UploadFile = File(...), user: SchemaHoursUserBase = Depends(require_bm)):
 
-        dateM=datetime.date(2023,month,1)
-        projectid = getattr(db.session.query(ModelProject).filter(ModelProject.project_code == project_code).first(),"id")
-
-        searched_record=db.session.query(ModelMonthlyModifiedHours).filter(
-                ModelMonthlyModifiedHours.project_id==projectid,
-                ModelMonthlyModifiedHours.month==dateM,
-                ModelMonthlyModifiedHours.user_id==user_id).first()
-            
-        if not searched_record:
-            db_monthlyhour = ModelMonthlyModifiedHours(
-                user_id = user_id,
-                project_id = projectid,
-                month = dateM,
-                total_hours = hours
-                )
-        
-            db.session.add(db_monthlyhour)
-        else:
-            searched_record.total_hours = hours
+    try:
+        monthly_import = await run_in_threadpool(run_import, MonthlyHoursImport, db.session.connection(), file.file)
+    except ImportFileError as e:
+        db.session.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
 
+    if monthly_import.error_count:
+        db.session.rollback()
+        raise HTTPException(status_code=400, detail=monthly_import.error_detail())
 
     db.session.commit()
     return {"message": "Import successful."}
@@ -2499,7 +2463,7 @@ async def import_csv_monthly(file: UploadFile = File(...)):
 
 # Get monthly_report /*/
 @app.get("/api/monthly_report")
-async def get_monthly_report(month: int, year: int, user = Depends(get_user)):
+def get_monthly_report(month: int, year: int, user = Depends(get_user)):
     
     model_monthly_report =db.session.query(ModelMonthlyReport).filter(
         ModelMonthlyReport.month == f'{year}-{month}-01'
@@ -2517,7 +2481,7 @@ async def get_monthly_report(month: int, year: int, user = Depends(get_user)):
 
 # Post monthly_report /*/
 @app.post("/api/monthly_report")
-async def get_monthly_report(monthlyReport: SchemaMonthlyReport, user = Depends(get_user)):
+def get_monthly_report(monthlyReport: SchemaMonthlyReport, user = Depends(require_bm)):
     
     model_monthly_report =db.session.query(ModelMonthlyReport).filter(
         ModelMonthlyReport.month == monthlyReport.month
@@ -2538,7 +2502,7 @@ async def get_monthly_report(monthlyReport: SchemaMonthlyReport, user = Depends(
 
 #  Change state monthly_report
 @app.put("/api/monthly_report")
-async def get_monthly_report(month: int, year: int, close: bool, user = Depends(get_user)):
+def get_monthly_report(month: int, year: int, close: bool, user = Depends(require_bm)):
     
 
     model_monthly_report =db.session.query(ModelMonthlyReport).filter(
@@ -2554,7 +2518,12 @@ async def get_monthly_report(month: int, year: int, close: bool, user = Depends(
 
 # Get monthly_report /*/
 @app.get("/api/projects/monthly-info")
-async def get_projects_monthly_infos(month: int, year: int, user = Depends(get_user)):
+def get_projects_monthly_infos(month: int, year: int, request: Request, response: Response, user = Depends(require_pm)):
+    versions = db.session.execute(select_versions("project_monthly_information")).all()
+    etag = make_etag("monthly-info", ["project_monthly_information"], versions, year, month)
+    not_modified = conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
     
     model_monthly_info =db.session.query(ModelProjectMonthlyInformation).filter(
         ModelProjectMonthlyInformation.month == f'{year}-{month}-01'
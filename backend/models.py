@@ -1,4 +1,4 @@
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Boolean, ForeignKeyConstraint, Numeric
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Boolean, ForeignKeyConstraint, Numeric, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -66,6 +66,8 @@ class RecordProjects(Base):
     
     
     __table_args__ = (ForeignKeyConstraint(['user_id', 'date_rec'], ['record.user_id', 'record.date_rec']),
+                      Index('ix_record_projects_project_id_date_rec', 'project_id', 'date_rec'),
+                      Index('ix_record_projects_user_id_date_rec', 'user_id', 'date_rec'),
     )
     
 class ProjectPhase(Base):
@@ -75,7 +77,7 @@ class ProjectPhase(Base):
     project_phase = Column(Integer,nullable=False, primary_key = True)
     start_date = Column(DateTime,nullable=False)
     end_date = Column(DateTime,nullable=False)
-    hours = Column(Integer)
+    hours = Column(Numeric(precision=10,scale=1))
 
 
 class MonthlyModifiedHours(Base):
@@ -87,12 +89,18 @@ class MonthlyModifiedHours(Base):
     total_hours = Column(Numeric(precision=3,scale=1))
     domain = Column(String, nullable=False, primary_key = True)
 
+    __table_args__ = (Index('ix_monthly_modified_hours_month_project_id', 'month', 'project_id'),
+    )
+
 class ProjectMonthlyInformation(Base):
     __tablename__ = "project_monthly_information"
     project_id = Column(Integer, ForeignKey("project.id"), primary_key = True)
     month = Column(DateTime,nullable=False, primary_key = True)
     forecast_hours = Column(Numeric(precision=3,scale=1), nullable=True)
     capitalizable = Column(String, nullable=True)
+
+    __table_args__ = (Index('ix_project_monthly_information_month', 'month'),
+    )
   
 
 class Favorites(Base):
@@ -102,11 +110,21 @@ class Favorites(Base):
         
     project_id = Column(Integer, ForeignKey("project.id"))
     user_id = Column(Integer, ForeignKey("hoursuser.id"))
-    
+
+    __table_args__ = (Index('ix_favorites_user_id_project_id', 'user_id', 'project_id'),
+    )
+
+
 class MonthlyReport(Base):
     __tablename__ = "monthly_report"
 
     sync_date = Column(DateTime,nullable=True)
     closed = Column(Boolean, nullable=False)
     month = Column(DateTime,nullable=False, primary_key=True)
-    
\ No newline at end of file
+
+
+class TableVersion(Base):
+    __tablename__ = "table_version"
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
@@ -0,0 +1,163 @@
+#General library imports
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+#Import SQLAlchemy dependencies
+from sqlalchemy import event
+
+
+
+MAX_STATEMENT_LENGTH = 500
+
+_current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("query_profile", default=None)
+
+
+class RequestProfile:
+    """SQL statements executed while serving one request."""
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+
+    def add(self, statement: str, elapsed: float):
+        self.statements += 1
+        self.db_time += elapsed
+        if elapsed >= self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_statement = statement
+
+
+class RouteMetrics:
+    """Per route aggregation of the request profiles, for one worker process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route: str, profile: RequestProfile, elapsed: float):
+        with self._lock:
+            metrics = self._routes.get(route)
+            if metrics is None:
+                metrics = self._routes[route] = {"requests": 0,
+                                                 "statements": 0,
+                                                 "max_statements": 0,
+                                                 "db_time": 0.0,
+                                                 "max_db_time": 0.0,
+                                                 "request_time": 0.0,
+                                                 "slowest_statement_time": 0.0,
+                                                 "slowest_statement": None}
+            metrics["requests"] += 1
+            metrics["statements"] += profile.statements
+            metrics["max_statements"] = max(metrics["max_statements"], profile.statements)
+            metrics["db_time"] += profile.db_time
+            metrics["max_db_time"] = max(metrics["max_db_time"], profile.db_time)
+            metrics["request_time"] += elapsed
+            if profile.slowest_statement is not None and profile.slowest_time >= metrics["slowest_statement_time"]:
+                metrics["slowest_statement_time"] = profile.slowest_time
+                metrics["slowest_statement"] = profile.slowest_statement[:MAX_STATEMENT_LENGTH]
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+    def as_dict(self):
+        with self._lock:
+            ans = {}
+            for route, metrics in sorted(self._routes.items()):
+                requests = metrics["requests"]
+                ans[route] = {"requests": requests,
+                              "avg_statements": round(metrics["statements"] / requests, 2),
+                              "max_statements": metrics["max_statements"],
+                              "avg_db_time_ms": round(metrics["db_time"] * 1000 / requests, 3),
+                              "max_db_time_ms": round(metrics["max_db_time"] * 1000, 3),
+                              "avg_request_time_ms": round(metrics["request_time"] * 1000 / requests, 3),
+                              "slowest_statement_ms": round(metrics["slowest_statement_time"] * 1000, 3),
+                              "slowest_statement": metrics["slowest_statement"]}
+            return {"pid": os.getpid(), "routes": ans}
+
+
+route_metrics = RouteMetrics()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get("query_start_time")
+    if not start_times:
+        return
+    elapsed = time.perf_counter() - start_times.pop()
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.add(statement, elapsed)
+
+
+def instrument_engine(engine):
+    # For an AsyncEngine, pass async_engine.sync_engine
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _route_path(scope) -> str:
+    # The router sets the endpoint in the scope of the request
+    endpoint = scope.get("endpoint")
+    if endpoint is not None:
+        for route in scope["app"].routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                return route.path
+    return "unmatched"
+
+
+class QueryProfilerMiddleware:
+    """Counts the SQL statements and the database time of every request, aggregates
+    them per route in `route_metrics` and optionally returns them as a Server-Timing header.
+
+    A plain ASGI middleware: the body of a streamed response goes straight to the client (the
+    BaseHTTPMiddleware of Starlette 0.14 queues it whole) and the statements run while it is sent
+    are counted, the request is recorded once its last chunk is sent. The Server-Timing header
+    is sent before the body, it only counts the statements run until then."""
+
+    def __init__(self, app, metrics: RouteMetrics = route_metrics, server_timing: bool = False):
+        self.app = app
+        self.metrics = metrics
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile()
+        start = time.perf_counter()
+        recorded = False
+
+        def record():
+            nonlocal recorded
+            if not recorded:
+                recorded = True
+                self.metrics.record(f"{scope['method']} {_route_path(scope)}", profile, time.perf_counter() - start)
+
+        async def send_profiled(message):
+            if message["type"] == "http.response.start" and self.server_timing:
+                elapsed = time.perf_counter() - start
+                server_timing = (f'db;dur={profile.db_time * 1000:.1f};desc="{profile.statements} queries", '
+                                 f'app;dur={elapsed * 1000:.1f}')
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", server_timing.encode("latin-1"))]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                record()
+
+        token = _current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            _current_profile.reset(token)
+            # Responses interrupted before their last chunk
+            record()
@@ -0,0 +1,84 @@
+#Fast JSON responses for the endpoints returning large lists
+#
+#FastAPI encodes the return value of an endpoint with jsonable_encoder, which walks every value in Python
+#before json.dumps. The large list endpoints opt in by returning json_response(request, content) instead:
+#the content is encoded by orjson (dates natively, Decimal and pydantic models through _default) and, over
+#JSON_COMPRESSION_MIN_SIZE bytes, compressed with brotli or gzip following the Accept-Encoding header.
+import gzip
+import os
+from decimal import Decimal
+
+import orjson
+from fastapi import Request, Response
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+#brotli is optional, gzip is used when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_COMPRESSION_MIN_SIZE = int(os.getenv("JSON_COMPRESSION_MIN_SIZE", "1024"))
+
+#Fast levels: the responses are compressed on every request
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        # Numbers, like jsonable_encoder
+        return float(value)
+    if isinstance(value, BaseModel):
+        return value.dict()
+    raise TypeError
+
+
+def dumps(content) -> bytes:
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def accepted_encoding(accept_encoding: str):
+    """Preferred encoding (br, then gzip) accepted by the Accept-Encoding header, None for the identity."""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.partition(";")
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith("q="):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if qualities.get(encoding, qualities.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+async def encoded_response(request: Request, body: bytes, status_code: int = 200, headers: dict = None) -> Response:
+    """Response of an already encoded JSON body, compressed when it is large enough."""
+    headers = dict(headers or {})
+    if len(body) >= JSON_COMPRESSION_MIN_SIZE:
+        headers["Vary"] = "Accept-Encoding"
+        encoding = accepted_encoding(request.headers.get("accept-encoding", ""))
+        if encoding:
+            # Out of the event loop, a multi-megabyte body takes several milliseconds
+            body = await run_in_threadpool(_compress, body, encoding)
+            headers["Content-Encoding"] = encoding
+    return Response(content=body, status_code=status_code, headers=headers, media_type="application/json")
+
+
+async def json_response(request: Request, content, status_code: int = 200, headers: dict = None) -> Response:
+    return await encoded_response(request, dumps(content), status_code, headers)
@@ -17,6 +17,9 @@ class FrontEndUser(HoursUserBase):
     class Config:
             orm_mode = True
 
+class AuthenticatedUser(FrontEndUser):
+    entities: List[str]
+
 class HoursUser(HoursUserBase):
     password: str
     domain: Optional[str]
@@ -75,6 +78,10 @@ class RecordProjects (BaseModel):
     class Config:
         orm_mode = True
 
+class RecordWeek (BaseModel):
+    record: Record
+    record_projects: List[RecordProjects]
+
 class Favorites (BaseModel):
     project_id: int
     user_id: int
@@ -0,0 +1,8 @@
+#!/bin/sh
+# Starts the API. RELOAD=true runs a single uvicorn process reloading on code changes (development),
+# otherwise gunicorn runs WEB_CONCURRENCY uvicorn workers with the settings of gunicorn.conf.py
+if [ "$RELOAD" = "true" ]; then
+    exec uvicorn main:app --host 0.0.0.0 --port "${PORT:-8080}" --reload
+else
+    exec gunicorn main:app -c gunicorn.conf.py
+fi
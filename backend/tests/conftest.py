@@ -0,0 +1,75 @@
+#Tests of the backend, run from the backend folder: python -m pytest tests
+#
+#The tests of the endpoints need an empty PostgreSQL database, given by TEST_DATABASE_URL (its tables are
+#dropped and created again), they are skipped otherwise. The tokens are not signed: get_user only reads
+#the name and the email of the payload.
+import base64
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if TEST_DATABASE_URL:
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+os.environ.setdefault("ORGANIZATIONS", "FOCAL,NAIM")
+
+USERS = {"ann": ("Ann", "ann@focal.fr"), "bob": ("Bob", "bob@naim.fr"), "pam": ("Pam", "pam@focal.fr")}
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+
+
+def auth_headers(user):
+    name, email = USERS[user]
+    payload = {"name": name, "unique_name": email, "exp": int(time.time()) + 3600}
+    return {"Authorization": "Bearer " + _b64({"alg": "none"}) + "." + _b64(payload) + ".sig"}
+
+
+def week(date_rec, *projects):
+    """Body of a week of records of Bob (Hardware), projects as (project_id, hours)."""
+    return {"record": {"date_rec": date_rec, "user_id": 2},
+            "record_projects": [{"project_id": project_id, "declared_hours": hours, "domain": "Hardware"}
+                                for project_id, hours in projects]}
+
+
+@pytest.fixture
+def engine():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    import models
+    from database import engine
+
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO hoursuser (id, username, email, domain, role, view, date_entrance, status) VALUES "
+            "(1, 'Ann', 'ann@focal.fr', 'Software', 'Business Manager', true, '2022-01-01', 'active'), "
+            "(2, 'Bob', 'bob@naim.fr', 'Hardware', 'Employee', true, '2022-01-01', 'active'), "
+            "(3, 'Pam', 'pam@focal.fr', 'Tests', 'Project Manager', true, '2022-01-01', 'active')")
+        connection.exec_driver_sql(
+            "INSERT INTO project (id, entity, division, sub_category, classification, type, project_name, project_code, "
+            "start_cap_date, end_cap_date, status) VALUES "
+            "(1, 'FOCAL', 'HOME', 'H_LSP', 'c', 't', 'P1', 'P1', '2023-01-01', '2024-12-31', 'open'), "
+            "(2, 'NAIM', 'PRO', 'ETC', 'c', 't', 'P2', 'P2', '2023-01-01', '2024-12-31', 'open')")
+        connection.exec_driver_sql(
+            "INSERT INTO project_phases VALUES (1, 1, '2023-01-01', '2024-12-31', 0), (2, 1, '2023-01-01', '2024-12-31', 0)")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def client(engine):
+    from fastapi.testclient import TestClient
+    from auth_utils import identity_cache
+    import main
+
+    identity_cache.clear()
+    main.project_catalog.invalidate()
+    return TestClient(main.app)
@@ -0,0 +1,46 @@
+from conftest import auth_headers
+
+
+def buffer_days(client, date_init, date_end):
+    response = client.get("/api/buffertable", params={"hours_user_id": 2, "date_init": date_init, "date_end": date_end},
+                          headers=auth_headers("bob"))
+    return sorted(row["day_date"][:10] for row in response.json())
+
+
+def test_submitted_week_clears_its_buffer_days(client):
+    bob = auth_headers("bob")
+    # Seven hours a day from Monday 2023-03-06 to Friday 2023-03-10, and the Monday of the next week
+    days = [{"user_id": 2, "day_date": "2023-03-%02d" % day, "project_id": 1, "daily_hours": 7} for day in range(6, 11)]
+    days.append({"user_id": 2, "day_date": "2023-03-13", "project_id": 2, "daily_hours": 7})
+    assert client.post("/api/buffertable", json=days, headers=bob).status_code == 200
+
+    response = client.post("/api/buffertable/submit", params={"date_rec": "2023-03-08"}, headers=bob)
+    assert response.status_code == 200
+    assert [(rp["project_id"], rp["declared_hours"]) for rp in response.json()["record_projects"]] == [(1, 35.0)]
+    assert buffer_days(client, "2023-03-01", "2023-03-31") == ["2023-03-13"]
+
+    # Checked by validate_weeks: a record on another day than Wednesday, a week recorded twice
+    response = client.post("/api/buffertable/submit", params={"date_rec": "2023-03-13"}, headers=bob)
+    assert (response.status_code, response.json()["detail"]) == (400, "Invalid date")
+    days = [{"user_id": 2, "day_date": "2023-03-06", "project_id": 1, "daily_hours": 7}]
+    assert client.post("/api/buffertable", json=days, headers=bob).status_code == 200
+    response = client.post("/api/buffertable/submit", params={"date_rec": "2023-03-08"}, headers=bob)
+    assert (response.status_code, response.json()["detail"]) == (409, "Record already exists")
+
+
+def test_submitted_week_has_the_domain_updated_by_another_worker(client, engine):
+    from catalog import bump_versions
+
+    bob = auth_headers("bob")
+    days = [{"user_id": 2, "day_date": "2023-03-%02d" % day, "project_id": 1, "daily_hours": 7} for day in range(6, 11)]
+    # Bob (Hardware) is now in the identity cache of this process
+    assert client.post("/api/buffertable", json=days, headers=bob).status_code == 200
+
+    # PUT /api/domain served by another worker process: the write and its version bump, no local invalidation
+    with engine.begin() as connection:
+        connection.exec_driver_sql("UPDATE hoursuser SET domain = 'Software' WHERE id = 2")
+        connection.execute(bump_versions("hoursuser"))
+
+    response = client.post("/api/buffertable/submit", params={"date_rec": "2023-03-08"}, headers=bob)
+    assert response.status_code == 200
+    assert [rp["domain"] for rp in response.json()["record_projects"]] == ["Software"]
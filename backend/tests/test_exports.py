@@ -0,0 +1,39 @@
+import pytest
+
+import exports
+from conftest import auth_headers, week
+
+
+@pytest.mark.parametrize("mode", ["copy", "cursor"])
+def test_records_export(client, monkeypatch, mode):
+    monkeypatch.setattr(exports, "CSV_EXPORT_MODE", mode)
+    bob = auth_headers("bob")
+    assert client.post("/api/records", json=week("2023-03-01", (1, 20), (2, 15)), headers=bob).status_code == 200
+    assert client.post("/api/records", json=week("2025-12-31", (2, 35)), headers=bob).status_code == 200
+
+    response = client.post("/api/export-records-csv", headers=auth_headers("pam"))
+    assert response.status_code == 200
+    # ISO week and year, 2025-12-31 is in the week 1 of 2026
+    assert response.content == (b"project_code;week;year;name;email;domain;hours\r\n"
+                                b"P1;9;2023;Bob;bob@naim.fr;Hardware;20.0\r\n"
+                                b"P2;9;2023;Bob;bob@naim.fr;Hardware;15.0\r\n"
+                                b"P2;1;2026;Bob;bob@naim.fr;Hardware;35.0\r\n")
+
+
+@pytest.mark.parametrize("mode", ["copy", "cursor"])
+def test_export_without_records(client, monkeypatch, mode):
+    monkeypatch.setattr(exports, "CSV_EXPORT_MODE", mode)
+    response = client.post("/api/export-records-csv", headers=auth_headers("pam"))
+    assert response.status_code == 200
+    assert response.content == b"project_code;week;year;name;email;domain;hours\r\n"
+
+
+@pytest.mark.parametrize("chunks_class", [exports.CopyChunks, exports.CursorChunks])
+def test_cancelled_export_stops(engine, chunks_class):
+    from sqlalchemy import func, select
+
+    # 200000 rows, more than a chunk
+    chunks = chunks_class(select(func.generate_series(1, 200000).label("n")))
+    assert next(chunks).startswith(b"n\r\n")
+    chunks.cancel()
+    assert list(chunks) == []
@@ -0,0 +1,38 @@
+from conftest import auth_headers, week
+
+
+def test_pool_status_is_for_business_managers(client):
+    assert client.get("/api/_internal/pool").status_code == 401
+    assert client.get("/api/_internal/pool", headers=auth_headers("bob")).status_code == 401
+    assert client.get("/api/_internal/pool", headers=auth_headers("ann")).status_code == 200
+
+
+def test_query_metrics_are_for_business_managers(client):
+    assert client.get("/api/_metrics").status_code == 401
+    assert client.get("/api/_metrics", headers=auth_headers("bob")).status_code == 401
+    assert client.delete("/api/_metrics", headers=auth_headers("bob")).status_code == 401
+
+    ann = auth_headers("ann")
+    client.get("/api/user", headers=ann)
+    assert "GET /api/user" in client.get("/api/_metrics", headers=ann).json()["routes"]
+    # The reset is a DELETE, a GET never changes the metrics
+    assert "GET /api/user" in client.get("/api/_metrics", params={"reset": "true"}, headers=ann).json()["routes"]
+    assert "GET /api/user" in client.delete("/api/_metrics", headers=ann).json()["routes"]
+    assert "GET /api/user" not in client.get("/api/_metrics", headers=ann).json()["routes"]
+
+
+def test_statements_of_streamed_bodies_are_counted(client, monkeypatch):
+    import exports
+
+    ann = auth_headers("ann")
+    assert client.post("/api/records", json=week("2023-03-01", (1, 35)), headers=auth_headers("bob")).status_code == 200
+    statements = {}
+    for mode in ("copy", "cursor"):
+        monkeypatch.setattr(exports, "CSV_EXPORT_MODE", mode)
+        client.delete("/api/_metrics", headers=ann)
+        assert client.post("/api/export-records-csv", headers=ann).status_code == 200
+        metrics = client.get("/api/_metrics", headers=ann).json()["routes"]["POST /api/export-records-csv"]
+        statements[mode] = metrics["max_statements"]
+    # The COPY runs in a thread of its own, not profiled. The cursor mode runs its statements (timeout and
+    # query) while the body is sent, after the response started
+    assert statements["cursor"] == statements["copy"] + 2
@@ -0,0 +1,154 @@
+#Tests of the signing keys cache, against a discovery document and a JWKS served on localhost
+import asyncio
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+from jose import jwt
+
+from jwks import JWKSKeyStore
+
+
+def _b64url(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, byteorder="big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def new_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    numbers = private_key.public_key().public_numbers()
+    jwk = {"kty": "RSA", "use": "sig", "kid": kid, "n": _b64url(numbers.n), "e": _b64url(numbers.e)}
+    return private_key, jwk
+
+
+class IdentityProvider:
+    """Discovery document and JWKS of a fake identity provider, the served keys can be swapped."""
+
+    def __init__(self):
+        self.jwks = {"keys": []}
+        self.requests = []
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                provider.requests.append(self.path)
+                if self.path == "/.well-known/openid-configuration":
+                    body = {"jwks_uri": provider.url + "/keys"}
+                elif self.path == "/keys":
+                    body = provider.jwks
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.discovery_url = self.url + "/.well-known/openid-configuration"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def serve(self, *jwks):
+        self.jwks = {"keys": list(jwks)}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def provider():
+    provider = IdentityProvider()
+    yield provider
+    provider.close()
+
+
+def public_numbers(key):
+    return key.public_numbers() if key is not None else None
+
+
+def test_cold_start_loads_the_keys_once(provider):
+    private_key, jwk = new_key("k1")
+    provider.serve(jwk)
+    store = JWKSKeyStore(provider.discovery_url, refresh_interval=0)
+
+    key = store.get_key("k1")
+    assert public_numbers(key) == private_key.public_key().public_numbers()
+    assert provider.requests == ["/.well-known/openid-configuration", "/keys"]
+
+    # Known keys are served from the cache
+    assert store.get_key("k1") is key
+    assert len(provider.requests) == 2
+
+
+def test_unknown_kid_refetches_at_most_once_per_interval(provider):
+    provider.serve(new_key("k1")[1])
+    store = JWKSKeyStore(provider.discovery_url, refresh_interval=0, min_refetch_interval=60)
+
+    assert store.get_key("forged") is None
+    assert len(provider.requests) == 2
+    assert store.get_key("forged") is None
+    assert store.get_key("other") is None
+    assert len(provider.requests) == 2
+    assert store.get_key("k1") is not None
+
+
+def test_rotated_key_is_picked_up(provider):
+    old_private_key, old_jwk = new_key("k1")
+    provider.serve(old_jwk)
+    store = JWKSKeyStore(provider.discovery_url, refresh_interval=0, min_refetch_interval=0.2)
+    assert store.get_key("k1") is not None
+
+    new_private_key, new_jwk = new_key("k2")
+    provider.serve(new_jwk)
+    # Too soon after the last fetch, then refetched
+    assert store.get_key("k2") is None
+    time.sleep(0.2)
+    assert public_numbers(store.get_key("k2")) == new_private_key.public_key().public_numbers()
+    # The retired key is gone with the refetch
+    assert store.get_key("k1") is None
+
+
+def run(coroutine):
+    # In a loop of its own, asyncio.run would also unset the current loop of the thread, used by the TestClient
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_auth_verifies_the_signature(provider, monkeypatch):
+    import auth_utils
+
+    private_key, jwk = new_key("k1")
+    provider.serve(jwk)
+    monkeypatch.setattr(auth_utils, "key_store", JWKSKeyStore(provider.discovery_url, refresh_interval=0))
+    pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    claims = {"name": "Ann", "unique_name": "ann@focal.fr"}
+
+    token = jwt.encode(claims, pem, algorithm="RS256", headers={"kid": "k1"})
+    assert run(auth_utils.test_auth(token)) == claims
+
+    other_pem = new_key("k1")[0].private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                               serialization.NoEncryption())
+    for token, detail in ((jwt.encode(claims, other_pem, algorithm="RS256", headers={"kid": "k1"}),
+                           "Invalid token signature"),
+                          (jwt.encode(claims, pem, algorithm="RS256", headers={"kid": "k9"}), "Unknown signing key")):
+        with pytest.raises(HTTPException) as error:
+            run(auth_utils.test_auth(token))
+        assert error.value.status_code == 401 and error.value.detail == detail
@@ -0,0 +1,70 @@
+from sqlalchemy import text
+
+from conftest import auth_headers, week
+
+
+def monthly_hours(engine):
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT user_id, project_id, domain, month, total_hours "
+                                       "FROM monthly_modified_hours ORDER BY 1, 2, 3, 4")).all()
+
+
+def reset(client, month, year):
+    response = client.post("/api/monthlyhours", params={"month": month, "year": year}, headers=auth_headers("ann"))
+    assert response.status_code == 200
+
+
+def test_week_inserted_then_edited_in_initialized_month(client, engine):
+    bob = auth_headers("bob")
+    assert client.post("/api/records", json=week("2023-03-01", (1, 35)), headers=bob).status_code == 200
+    reset(client, 3, 2023)
+
+    # Weeks written after the reset are added to the month, then edited as deltas
+    assert client.post("/api/records", json=week("2023-03-08", (1, 20), (2, 15)), headers=bob).status_code == 200
+    assert client.post("/api/records/batch", json=[week("2023-03-15", (2, 35))], headers=bob).status_code == 200
+    assert client.put("/api/records", json=week("2023-03-08", (1, 5), (2, 30)), headers=bob).status_code == 200
+
+    incremental = monthly_hours(engine)
+    assert [(row.project_id, float(row.total_hours)) for row in incremental] == [(1, 40.0), (2, 65.0)]
+    # Same hours as a reset of the month from the records
+    reset(client, 3, 2023)
+    assert monthly_hours(engine) == incremental
+
+
+def test_week_of_month_not_initialized_is_left_to_reset(client, engine):
+    assert client.post("/api/records", json=week("2023-03-01", (1, 35)), headers=auth_headers("bob")).status_code == 200
+    assert monthly_hours(engine) == []
+
+
+def test_buffer_week_submitted_in_initialized_month(client, engine):
+    bob = auth_headers("bob")
+    assert client.post("/api/records", json=week("2023-03-01", (1, 35)), headers=bob).status_code == 200
+    reset(client, 3, 2023)
+
+    # Seven hours a day from Monday to Friday, recorded for the Wednesday of the week
+    days = [{"user_id": 2, "day_date": "2023-03-%02d" % day, "project_id": 2, "daily_hours": 7} for day in range(6, 11)]
+    assert client.post("/api/buffertable", json=days, headers=bob).status_code == 200
+    assert client.post("/api/buffertable/submit", params={"date_rec": "2023-03-08"}, headers=bob).status_code == 200
+
+    incremental = monthly_hours(engine)
+    assert [(row.project_id, float(row.total_hours)) for row in incremental] == [(1, 35.0), (2, 35.0)]
+    reset(client, 3, 2023)
+    assert monthly_hours(engine) == incremental
+
+
+def test_records_imported_in_initialized_month(client, engine):
+    assert client.post("/api/records", json=week("2023-03-01", (1, 35)), headers=auth_headers("bob")).status_code == 200
+    reset(client, 3, 2023)
+
+    # Week 9 (2023-03-01) is replaced, week 10 (2023-03-08) is new
+    csv_file = ("project_code;week;year;name;email;domain;hours\n"
+                "P1;9;2023;Bob;bob@naim.fr;Hardware;20\n"
+                "P2;9;2023;Bob;bob@naim.fr;Hardware;15\n"
+                "P2;10;2023;Bob;bob@naim.fr;Hardware;35\n")
+    response = client.post("/api/import-csv", files={"file": ("records.csv", csv_file)}, headers=auth_headers("pam"))
+    assert response.status_code == 200
+
+    incremental = monthly_hours(engine)
+    assert [(row.project_id, float(row.total_hours)) for row in incremental] == [(1, 20.0), (2, 50.0)]
+    reset(client, 3, 2023)
+    assert monthly_hours(engine) == incremental
@@ -0,0 +1,26 @@
+from sqlalchemy import text
+
+from aggregates import recompute_phase_hours
+from conftest import auth_headers, week
+
+
+def phase_hours(engine):
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT project_id, project_phase, hours FROM project_phases ORDER BY 1, 2")).all()
+
+
+def test_deltas_add_up_to_the_recompute(client, engine):
+    bob = auth_headers("bob")
+    assert client.post("/api/records", json=week("2023-03-01", (1, 17.5), (2, 17.5)), headers=bob).status_code == 200
+    assert [float(row.hours) for row in phase_hours(engine)] == [17.5, 17.5]
+
+    # A delta then its reverse, the totals come back exactly
+    assert client.put("/api/records", json=week("2023-03-01", (1, 35), (2, 0)), headers=bob).status_code == 200
+    assert [float(row.hours) for row in phase_hours(engine)] == [35.0, 0.0]
+    assert client.put("/api/records", json=week("2023-03-01", (1, 17.5), (2, 17.5)), headers=bob).status_code == 200
+    incremental = phase_hours(engine)
+    assert [float(row.hours) for row in incremental] == [17.5, 17.5]
+
+    with engine.begin() as connection:
+        connection.execute(recompute_phase_hours())
+    assert phase_hours(engine) == incremental